@@ -6,11 +6,14 @@ Description:
     Initializes extensions and registers blueprints.
 Usage:
     - create_app(config_class=Config): Create and configure the Flask app instance.
+    - configure_database_pool(app): Set the connection pool options of the database engine.
 """
 
+import atexit
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
+from logging.handlers import SMTPHandler, QueueHandler
 import os
+from queue import Queue
 from flask import Flask, request, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -18,18 +21,60 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
+from jinja2 import FileSystemBytecodeCache
 from config import Config
-from elasticsearch import Elasticsearch
+from app.log import BatchQueueListener, BatchRotatingFileHandler
 
 
 def get_locale() -> str | None:
     """
     Selects the best match for supported languages based on the client's
     Accept-Language header.
+    Parsing the header is skipped when only one language is supported, when the
+    client does not send the header, or when the client's preferred language is
+    the default language, which is the most common case.
     :return: The best matching language code.
     """
+    default = current_app.config['DEFAULT_LANGUAGE']
+    if len(current_app.config['LANGUAGES']) == 1:
+        return default
+    header = request.headers.get('Accept-Language')
+    if not header:
+        return default
+    preferred = header.partition(',')[0]
+    if ';' not in preferred and \
+            preferred.partition('-')[0].strip().lower() == default:
+        return default
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
+
+def configure_database_pool(app) -> None:
+    """
+    Add the connection pool options to the engine options of the app.
+    Connections are checked before use, so that a restart of the database server
+    does not result in errors, and are replaced after DATABASE_POOL_RECYCLE seconds.
+    SQLite is left with its default pool, which does not accept these options.
+    On PostgreSQL, statements that run longer than DATABASE_STATEMENT_TIMEOUT
+    milliseconds are canceled.
+    :param app: The Flask application instance.
+    :return: None
+    """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite'):
+        return
+    options = {
+        'pool_size': app.config['DATABASE_POOL_SIZE'],
+        'max_overflow': app.config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': app.config['DATABASE_POOL_TIMEOUT'],
+        'pool_recycle': app.config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+    if uri.startswith('postgresql'):
+        timeout = app.config['DATABASE_STATEMENT_TIMEOUT']
+        options['connect_args'] = {'options': f'-c statement_timeout={timeout}'}
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
 # Initialize Flask extensions
 db = SQLAlchemy()
 migrate = Migrate()
@@ -49,8 +94,22 @@ def create_app(config_class=Config) -> Flask:
     """
     app = Flask(__name__)
     app.config.from_object(config_class)
+    app.config['DEFAULT_LANGUAGE'] = app.config['LANGUAGES'][0]
+    app.config.setdefault('RESET_SENDER', app.config['ADMINS'][0])
+
+    # Compiled templates are stored on disk, so that new worker processes
+    # don't need to compile them again. Without a configured directory, Jinja
+    # uses one in the temporary directory that belongs to the current user and
+    # is only accessible by it. The cache is not used while developing or testing.
+    if not app.debug and not app.testing:
+        if app.config['JINJA_BYTECODE_CACHE_DIR']:
+            os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], mode=0o700,
+                        exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['JINJA_BYTECODE_CACHE_DIR'])
 
     # Initialize extensions 
+    configure_database_pool(app)
     db.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
@@ -60,12 +119,17 @@ def create_app(config_class=Config) -> Flask:
     # Elasticsearch presents the challenge that it isn't wrapped by a Flask extension.
     # You cannot create the Elasticsearch instance in the global scope like we did above,
     # because to inizialize it we need access to app.config, which only becomes
-    # available after the create_app() function is invoked. The solution here is to add
-    # a elasticsearch attribute to the app instance in the application factory function.
-    # Adding a new attribute to the app instance may seem a little strange,
-    # but Python objects are not strict in their structure,
-    # and new attributes can be added to them at any time.
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None # pyright: ignore[reportAttributeAccessIssue]
+    # available after the create_app() function is invoked. The client is not created
+    # here either: get_es() in app/search.py builds it the first time it is needed and
+    # stores it in app.extensions, so that apps that never search don't pay for it.
+
+    # Background thread that delivers the emails queued by send_email()
+    from app.email import start_mail_worker
+    start_mail_worker(app)
+
+    # Connection to the translation service, opened before the first translation
+    from app.translate import warm_up
+    warm_up(app)
 
     # Blueprint registrations
     from app.errors import bp as errors_bp
@@ -74,14 +138,15 @@ def create_app(config_class=Config) -> Flask:
     from app.auth import bp as auth_bp
     app.register_blueprint(auth_bp, url_prefix='/auth')
 
-    from app.main import bp as main_bp
-    app.register_blueprint(main_bp)
+    from app.main import init_app as init_main
+    init_main(app)
 
     from app.cli import bp as cli_bp
     app.register_blueprint(cli_bp)
 
     # Logging configuration
     if not app.debug and not app.testing: # This ensures logging is not set up during testing or debugging
+        handlers: list[logging.Handler] = []
         if app.config['MAIL_SERVER']:
             auth = None
             if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
@@ -96,17 +161,32 @@ def create_app(config_class=Config) -> Flask:
                 toaddrs=app.config['ADMINS'], subject='Microblog Failure',
                 credentials=auth, secure=secure)
             mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
+            handlers.append(mail_handler)
 
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/microblog.log',
-                                           maxBytes=10240, backupCount=10)
+        os.makedirs('logs', exist_ok=True)
+        file_handler = BatchRotatingFileHandler('logs/microblog.log',
+                                                maxBytes=10240, backupCount=10)
         file_handler.setFormatter(logging.Formatter(
             '%(asctime)s %(levelname)s: %(message)s '
             '[in %(pathname)s:%(lineno)d]'))
         file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+        # The handlers do their formatting and I/O in a listener thread, so that
+        # logging from a request only costs a put on the log queue. The listener
+        # writes the records to the log file in batches.
+        # All app instances share the same logger, so the queue handler of an
+        # app created earlier in this process is replaced rather than duplicated.
+        log_queue: Queue[logging.LogRecord] = Queue(-1)
+        for handler in app.logger.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                app.logger.removeHandler(handler)
+        app.logger.addHandler(QueueHandler(log_queue))
+        log_listener = BatchQueueListener(log_queue, *handlers,
+                                          respect_handler_level=True)
+        app.extensions['log_listener'] = log_listener
+        log_listener.start()
+        atexit.register(log_listener.stop)
 
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
@@ -4,10 +4,29 @@ Author: Michele Grieco
 Description:
     This module initializes the authentication blueprint for the Flask application.
     It sets up the blueprint and imports the routes associated with authentication.
+    When the blueprint is registered, the templates of the authentication pages are
+    compiled, so that the first request to each page does not have to load and compile
+    its template. Later renders use the compiled templates cached by Jinja, which
+    are not checked against the template files unless template auto reload is enabled.
 """
 
 from flask import Blueprint
 
 bp = Blueprint('auth', __name__)
 
+TEMPLATES = ['auth/login.html', 'auth/register.html',
+             'auth/reset_password_request.html', 'auth/reset_password.html',
+             'email/reset_password.multi']
+
+
+@bp.record_once
+def preload_templates(state) -> None:
+    """
+    Load and compile the templates used by the authentication blueprint.
+    :param state: The blueprint setup state.
+    :return: None
+    """
+    for name in TEMPLATES:
+        state.app.jinja_env.get_template(name)
+
 from app.auth import routes
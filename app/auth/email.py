@@ -3,6 +3,8 @@ Module name: email.py
 Author: Michele Grieco
 Description:
     This module contains functions for sending emails related to user authentication, such as password reset emails.
+    The plain text and HTML bodies of an email are rendered together from a single template,
+    in which the two parts are divided by a separator line.
 Usage:
     - send_password_reset_email(user): Sends a password reset email to the specified user.
 """
@@ -11,6 +13,8 @@ from flask import render_template, current_app
 from flask_babel import _
 from app.email import send_email
 
+BODY_SEPARATOR = '--- html body ---'
+
 
 def send_password_reset_email(user) -> None:
     """
@@ -21,10 +25,11 @@ def send_password_reset_email(user) -> None:
     :return: None
     """
     token = user.get_reset_password_token()
+    text_body, html_body = render_template(
+        'email/reset_password.multi', user=user, token=token,
+        separator=BODY_SEPARATOR).split('\n' + BODY_SEPARATOR + '\n', 1)
     send_email(_('[Microblog] Reset Your Password'),
-               sender=current_app.config['ADMINS'][0],
+               sender=current_app.config['RESET_SENDER'],
                recipients=[user.email],
-               text_body=render_template('email/reset_password.txt',
-                                         user=user, token=token),
-               html_body=render_template('email/reset_password.html',
-                                         user=user, token=token))
+               text_body=text_body,
+               html_body=html_body)
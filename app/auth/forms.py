@@ -9,64 +9,156 @@ Usage:
     - RegistrationForm: Form for new user registration.
     - ResetPasswordRequestForm: Form to request a password reset.
     - ResetPasswordForm: Form to reset the password.
+    - CachedEmail: Email validator that remembers the result for recently validated addresses.
+    - duplicate_field(error): Find the user field whose unique index an IntegrityError violated.
 """
 
+from functools import lru_cache
+import email_validator
 from flask_wtf import FlaskForm
 from flask_babel import _, lazy_gettext as _l
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
-from wtforms.validators import ValidationError, DataRequired, Email, EqualTo
-import sqlalchemy as sa
-from app import db
-from app.models import User
+from wtforms.validators import ValidationError, DataRequired, Email, \
+    EqualTo, Length
+
+# Labels shared by several forms, so that each lazy string is created only once
+USERNAME_LABEL = _l('Username')
+EMAIL_LABEL = _l('Email')
+PASSWORD_LABEL = _l('Password')
+REPEAT_PASSWORD_LABEL = _l('Repeat Password')
+RESET_PASSWORD_LABEL = _l('Request Password Reset')
+
+
+# Fields of the user table by the name of their unique index; SQLite names
+# the columns of plain indexes instead of the index
+_UNIQUE_FIELDS = {
+    'ix_user_email': 'email',
+    'ix_user_username': 'username',
+    'ix_user_username_lower': 'username',
+    'user.email': 'email',
+    'user.username': 'username',
+}
+
+
+def duplicate_field(error) -> str | None:
+    """
+    Find the field of the user table whose unique index was violated.
+    PostgreSQL gives the name of the index in the diagnostics of the error,
+    while SQLite only puts it in the message.
+    :param error: The IntegrityError raised by the database.
+    :return: 'username' or 'email', or None if the error is not a violation of their indexes.
+    """
+    diag = getattr(error.orig, 'diag', None)
+    name = getattr(diag, 'constraint_name', None)
+    if name is None:
+        message = str(error.orig)
+        prefix = 'UNIQUE constraint failed: '
+        if not message.startswith(prefix):
+            return None
+        name = message[len(prefix):]
+        if name.startswith('index '):
+            name = name[len('index '):].strip("'")
+    return _UNIQUE_FIELDS.get(name)
+
+
+@lru_cache(maxsize=1024)
+def email_error(email, check_deliverability, allow_smtputf8,
+                allow_empty_local) -> str | None:
+    """
+    Validate an email address with the email_validator package.
+    The results are cached, so that repeated submissions of the same address,
+    which are common with bots, don't parse it again.
+    :param email: The email address to validate.
+    :param check_deliverability: Whether to resolve the domain name.
+    :param allow_smtputf8: Whether to accept addresses that need SMTPUTF8.
+    :param allow_empty_local: Whether to accept an empty local part.
+    :return: The reason the address is not valid, or None if it is valid.
+    """
+    try:
+        email_validator.validate_email(
+            email, check_deliverability=check_deliverability,
+            allow_smtputf8=allow_smtputf8,
+            allow_empty_local=allow_empty_local)
+    except email_validator.EmailNotValidError as e:
+        return str(e)
+    return None
+
+
+class CachedEmail(Email):
+    def __call__(self, form, field):
+        """
+        Validate the email address in the field, using cached results.
+        :param form: The form the field belongs to.
+        :param field: The field to validate.
+        :raise ValidationError: If the email address is not valid.
+        :return: None
+        """
+        if field.data is None:
+            error = ''
+        else:
+            error = email_error(field.data, self.check_deliverability,
+                                self.allow_smtputf8, self.allow_empty_local)
+        if error is not None:
+            message = self.message
+            if message is None:
+                if self.granular_message and error:
+                    message = field.gettext(error)
+                else:
+                    message = field.gettext('Invalid email address.')
+            raise ValidationError(message)
+
+
+# Validators shared by the email and repeat password fields of all the forms.
+# Deliverability is not checked, so validating an address never needs a DNS query.
+EMAIL_VALIDATORS = [DataRequired(), Length(max=120),
+                    CachedEmail(check_deliverability=False)]
+REPEAT_PASSWORD_VALIDATORS = [DataRequired(), EqualTo('password')]
 
 
 class LoginForm(FlaskForm):
-    username = StringField(_l('Username'), validators=[DataRequired()])
-    password = PasswordField(_l('Password'), validators=[DataRequired()])
+    username = StringField(USERNAME_LABEL, validators=[DataRequired()])
+    password = PasswordField(PASSWORD_LABEL, validators=[DataRequired()])
     remember_me = BooleanField(_l('Remember Me'))
     submit = SubmitField(_l('Sign In'))
 
 
 class RegistrationForm(FlaskForm):
-    username = StringField(_l('Username'), validators=[DataRequired()])
-    email = StringField(_l('Email'), validators=[DataRequired(), Email()])
-    password = PasswordField(_l('Password'), validators=[DataRequired()])
-    password2 = PasswordField(
-        _l('Repeat Password'), validators=[DataRequired(),
-                                           EqualTo('password')])
+    username = StringField(USERNAME_LABEL,
+                           validators=[DataRequired(), Length(max=64)])
+    email = StringField(EMAIL_LABEL, validators=EMAIL_VALIDATORS)
+    password = PasswordField(PASSWORD_LABEL, validators=[DataRequired()])
+    password2 = PasswordField(REPEAT_PASSWORD_LABEL,
+                              validators=REPEAT_PASSWORD_VALIDATORS)
     submit = SubmitField(_l('Register'))
 
-    def validate_username(self, username):
-        """
-        Validate that the username is unique.
-        :param username: The username field to validate.
-        :raise ValidationError: If the username is already taken.
-        :return: None
-        """
-        user = db.session.scalar(sa.select(User).where(
-            User.username == username.data))
-        if user is not None:
-            raise ValidationError(_('Please use a different username.'))
-
-    def validate_email(self, email):
+    def add_duplicate_error(self, error) -> None:
         """
-        Validate that the email is unique.
-        :param email: The email field to validate.
-        :raise ValidationError: If the email is already registered.
+        Report on the right field that the username or the email are already
+        registered. Uniqueness is not checked during validation; it is enforced
+        by the unique indexes of the user table, and the register view calls this
+        method when inserting the new user violates one of them.
+        The field is found from the name of the violated index, so that the
+        values in the error message cannot be mistaken for it.
+        :param error: The IntegrityError raised by the database.
+        :raise IntegrityError: If the error is not the violation of one of those indexes.
         :return: None
         """
-        user = db.session.scalar(sa.select(User).where(
-            User.email == email.data))
-        if user is not None:
-            raise ValidationError(_('Please use a different email address.'))
+        field = duplicate_field(error)
+        if field == 'email':
+            self.email.errors.append(_('Please use a different email address.'))
+        elif field == 'username':
+            self.username.errors.append(_('Please use a different username.'))
+        else:
+            raise error
 
 
 class ResetPasswordRequestForm(FlaskForm):
-    email = StringField(_l('Email'), validators=[DataRequired(), Email()])
-    submit = SubmitField(_l('Request Password Reset'))
+    email = StringField(EMAIL_LABEL, validators=EMAIL_VALIDATORS)
+    submit = SubmitField(RESET_PASSWORD_LABEL)
 
 
 class ResetPasswordForm(FlaskForm):
-    password = PasswordField(_l('Password'), validators=[DataRequired()])
-    password2 = PasswordField(_l('Repeat Password'), validators=[DataRequired(), EqualTo('password')])
-    submit = SubmitField(_l('Request Password Reset'))
+    password = PasswordField(PASSWORD_LABEL, validators=[DataRequired()])
+    password2 = PasswordField(REPEAT_PASSWORD_LABEL,
+                              validators=REPEAT_PASSWORD_VALIDATORS)
+    submit = SubmitField(RESET_PASSWORD_LABEL)
@@ -13,18 +13,76 @@ Usage:
     - /reset_password/<token>: Route to reset the password using a token.
 """
 
-from flask import render_template, redirect, url_for, flash, request
+from flask import render_template, redirect, url_for, flash, request, \
+    make_response
 from urllib.parse import urlsplit
 from flask_login import login_user, logout_user, current_user
 from flask_babel import _
-import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
 from app import db
 from app.auth import bp
-from app.auth.forms import LoginForm, RegistrationForm, ResetPasswordRequestForm, ResetPasswordForm
-from app.models import User
+from app.models import User, dummy_password_hash, verify_password
 from app.auth.email import send_password_reset_email
 
 
+# URLs of endpoints without arguments, by endpoint and application root
+_static_urls = {}
+
+
+def static_url_for(endpoint) -> str:
+    """
+    Return the URL of an endpoint that takes no arguments.
+    The URL only depends on the endpoint and on the root the application is
+    mounted at, so it is built once and then reused.
+    :param endpoint: The endpoint name.
+    :return: The URL of the endpoint.
+    """
+    key = (endpoint, request.script_root)
+    url = _static_urls.get(key)
+    if url is None:
+        url = _static_urls[key] = url_for(endpoint)
+    return url
+
+
+def is_safe_next_page(next_page) -> bool:
+    """
+    Check that the page to redirect to after login is a path on this site.
+    Only absolute paths are accepted. Values with control characters or
+    whitespace are rejected, because browsers drop some of them from URLs, so
+    that '/\t/evil.com' becomes '//evil.com', and others cannot be sent in a
+    header. Backslashes are read as slashes, as browsers do, and the path must
+    not begin with two slashes or have a scheme or a host.
+    :param next_page: The value of the next query string argument.
+    :return: True if it is safe to redirect to the page, False otherwise.
+    """
+    if not next_page or not next_page.startswith('/'):
+        return False
+    if any(ord(c) <= 32 or ord(c) == 127 for c in next_page):
+        return False
+    next_page = next_page.replace('\\', '/')
+    if next_page.startswith('//'):
+        return False
+    url = urlsplit(next_page)
+    return not url.netloc and not url.scheme
+
+
+def cacheable_form_page(html):
+    """
+    Build the response for the GET of an anonymous form page, allowing the
+    browser to reuse it for a short time.
+    The page contains a CSRF token bound to the user's session, so it can only be
+    cached privately, and only for requests that send the same session cookie.
+    :param html: The rendered page.
+    :return: The response object.
+    """
+    response = make_response(html)
+    if request.method == 'GET':
+        response.cache_control.private = True
+        response.cache_control.max_age = 30
+        response.vary.update(('Accept-Language', 'Cookie'))
+    return response
+
+
 @bp.route('/login', methods=['GET', 'POST'])
 def login():
     """
@@ -35,20 +93,26 @@ def login():
     :return: Rendered login template or redirect response.
     """
     if current_user.is_authenticated:
-        return redirect(url_for('main.index'))
+        return redirect(static_url_for('main.index'))
+    from app.auth.forms import LoginForm
     form = LoginForm()
     if form.validate_on_submit():
-        user = db.session.scalar(
-            sa.select(User).where(User.username == form.username.data))
+        user = User.get_for_login(form.username.data)
+        if user is None:
+            verify_password(dummy_password_hash(), form.password.data)
         if user is None or not user.check_password(form.password.data):
             flash(_('Invalid username or password'))
-            return redirect(url_for('auth.login'))
+            return redirect(static_url_for('auth.login'))
+        if db.session.is_modified(user):
+            # the password hash was upgraded by check_password()
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
-        if not next_page or urlsplit(next_page).netloc != '':
-            next_page = url_for('main.index')
+        if not is_safe_next_page(next_page):
+            next_page = static_url_for('main.index')
         return redirect(next_page)
-    return render_template('auth/login.html', title=_('Sign In'), form=form)
+    return cacheable_form_page(
+        render_template('auth/login.html', title=_('Sign In'), form=form))
 
 
 @bp.route('/logout')
@@ -58,7 +122,7 @@ def logout():
     :return: Redirect response to the main index.
     """
     logout_user()
-    return redirect(url_for('main.index'))
+    return redirect(static_url_for('main.index'))
 
 
 @bp.route('/register', methods=['GET', 'POST'])
@@ -68,20 +132,27 @@ def register():
     If the user is already authenticated, redirect to the main index.
     If the registration form is submitted and valid, create a new user,
     set their password, and commit to the database. Then redirect to the login page.
+    If the username or the email are already registered, the unique indexes of the
+    user table reject the new user, and the form is shown again with the error.
     :return: Rendered registration template or redirect response.
     """
     if current_user.is_authenticated:
-        return redirect(url_for('main.index'))
+        return redirect(static_url_for('main.index'))
+    from app.auth.forms import RegistrationForm
     form = RegistrationForm()
     if form.validate_on_submit():
-        user = User(username=form.username.data, email=form.email.data)
-        user.set_password(form.password.data)
-        db.session.add(user)
-        db.session.commit()
-        flash(_('Congratulations, you are now a registered user!'))
-        return redirect(url_for('auth.login'))
-    return render_template('auth/register.html', title=_('Register'),
-                           form=form)
+        try:
+            User.create(form.username.data, form.email.data,
+                        form.password.data)
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            form.add_duplicate_error(error)
+        else:
+            flash(_('Congratulations, you are now a registered user!'))
+            return redirect(static_url_for('auth.login'))
+    return cacheable_form_page(
+        render_template('auth/register.html', title=_('Register'), form=form))
 
 
 @bp.route('/reset_password_request', methods=['GET', 'POST'])
@@ -94,16 +165,16 @@ def reset_password_request():
     :return: Rendered reset password request template or redirect response.
     """
     if current_user.is_authenticated:
-        return redirect(url_for('main.index'))
+        return redirect(static_url_for('main.index'))
+    from app.auth.forms import ResetPasswordRequestForm
     form = ResetPasswordRequestForm()
     if form.validate_on_submit():
-        user = db.session.scalar(
-            sa.select(User).where(User.email == form.email.data))
+        user = User.get_by_email(form.email.data)
         if user:
             send_password_reset_email(user)
         flash(
             _('Check your email for the instructions to reset your password'))
-        return redirect(url_for('auth.login'))
+        return redirect(static_url_for('auth.login'))
     return render_template('auth/reset_password_request.html',
                            title=_('Reset Password'), form=form)
 
@@ -119,14 +190,15 @@ def reset_password(token):
     :return: Rendered reset password template or redirect response.
     """
     if current_user.is_authenticated:
-        return redirect(url_for('main.index'))
+        return redirect(static_url_for('main.index'))
     user = User.verify_reset_password_token(token)
     if not user:
-        return redirect(url_for('main.index'))
+        return redirect(static_url_for('main.index'))
+    from app.auth.forms import ResetPasswordForm
     form = ResetPasswordForm()
     if form.validate_on_submit():
         user.set_password(form.password.data)
         db.session.commit()
         flash(_('Your password has been reset.'))
-        return redirect(url_for('auth.login'))
+        return redirect(static_url_for('auth.login'))
     return render_template('auth/reset_password.html', form=form)
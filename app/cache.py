@@ -0,0 +1,72 @@
+"""
+Module name: cache.py
+Author: Michele Grieco
+Description:
+    Redis cache shared by the worker processes of the application.
+    Redis is optional: when REDIS_URL is not configured or the redis package is
+    not installed, get_redis() returns None and the helpers in this module
+    behave as a cache that never has the requested value. Errors from the Redis
+    server are logged and otherwise ignored, so that the application keeps
+    working, only slower, when the cache is down.
+Usage:
+    - get_redis(): Return the Redis client of the current app, creating it on first use.
+    - get_page(key): Return a rendered page stored in the cache, or None.
+    - set_page(key, html): Store a rendered page in the cache for PAGE_CACHE_TIMEOUT seconds.
+"""
+
+from flask import current_app
+
+
+def get_redis():
+    """
+    Return the Redis client of the current application.
+    The client is created the first time it is requested and then reused for
+    the lifetime of the application. It has short timeouts, because a slow
+    cache must not be slower than the work it saves.
+    :return: The Redis client, or None if REDIS_URL is not configured or the redis package is not installed.
+    """
+    r = current_app.extensions.get('redis')
+    if r is None and current_app.config['REDIS_URL']:
+        try:
+            import redis # type: ignore[import-not-found]
+        except ImportError: # redis is not installed
+            return None
+        r = redis.Redis.from_url(current_app.config['REDIS_URL'],
+                                 socket_timeout=0.5,
+                                 socket_connect_timeout=0.5)
+        current_app.extensions['redis'] = r
+    return r
+
+
+def get_page(key) -> str | None:
+    """
+    Return a rendered page stored in the cache.
+    :param key: The key the page was stored with.
+    :return: The HTML of the page, or None if it is not in the cache.
+    """
+    r = get_redis()
+    if r is None:
+        return None
+    try:
+        html = r.get(f'page:v1:{key}')
+    except Exception:
+        current_app.logger.warning('Page cache is not available', exc_info=True)
+        return None
+    return html.decode('utf-8') if html is not None else None
+
+
+def set_page(key, html) -> None:
+    """
+    Store a rendered page in the cache for PAGE_CACHE_TIMEOUT seconds.
+    :param key: The key of the page.
+    :param html: The HTML of the page.
+    :return: None
+    """
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        r.setex(f'page:v1:{key}', current_app.config['PAGE_CACHE_TIMEOUT'],
+                html)
+    except Exception:
+        current_app.logger.warning('Page cache is not available', exc_info=True)
@@ -23,12 +23,30 @@ Usage:
 """
 
 import os
+from babel.messages.frontend import CommandLineInterface
 from flask import Blueprint
 import click
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
 
+def pybabel(*args) -> None:
+    """
+    Run a pybabel command inside the current process.
+    Calling the Babel command line interface directly avoids spawning a shell
+    and a second Python interpreter for every command.
+    :param args: The pybabel command and its arguments.
+    :raise RuntimeError: If the command fails.
+    :return: None
+    """
+    try:
+        failed = CommandLineInterface().run(['pybabel', *args])
+    except (Exception, SystemExit) as e:
+        raise RuntimeError(args[0] + ' command failed') from e
+    if failed:
+        raise RuntimeError(args[0] + ' command failed')
+
+
 @bp.cli.group()
 def translate() -> None:
     """Translation and localization commands."""
@@ -39,26 +57,26 @@ def translate() -> None:
 @click.argument('lang')
 def init(lang) -> None:
     """Initialize a new language."""
-    if os.system('pybabel extract -F babel.cfg -k _l -o messages.pot .'):
-        raise RuntimeError('extract command failed')
-    if os.system(
-            'pybabel init -i messages.pot -d app/translations -l ' + lang):
-        raise RuntimeError('init command failed')
-    os.remove('messages.pot')
+    try:
+        pybabel('extract', '-F', 'babel.cfg', '-k', '_l', '-o', 'messages.pot', '.')
+        pybabel('init', '-i', 'messages.pot', '-d', 'app/translations', '-l', lang)
+    finally:
+        if os.path.exists('messages.pot'):
+            os.remove('messages.pot')
 
 
 @translate.command()
 def update() -> None:
     """Update all languages."""
-    if os.system('pybabel extract -F babel.cfg -k _l -o messages.pot .'):
-        raise RuntimeError('extract command failed')
-    if os.system('pybabel update -i messages.pot -d app/translations'):
-        raise RuntimeError('update command failed')
-    os.remove('messages.pot')
+    try:
+        pybabel('extract', '-F', 'babel.cfg', '-k', '_l', '-o', 'messages.pot', '.')
+        pybabel('update', '-i', 'messages.pot', '-d', 'app/translations')
+    finally:
+        if os.path.exists('messages.pot'):
+            os.remove('messages.pot')
 
 
 @translate.command()
 def compile() -> None:
     """Compile all languages."""
-    if os.system('pybabel compile -d app/translations'):
-        raise RuntimeError('compile command failed')
+    pybabel('compile', '-d', 'app/translations')
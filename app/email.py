@@ -3,39 +3,98 @@ Module name: email.py
 Author: Michele Grieco
 Description:
     Email sending functions.
-    In the send_email() function, the application instance is passed as an argument
-    to a background thread that will then deliver the email without blocking the main application.
-    Using current_app directly in the send_async_email() function that runs as a background thread
-    would not have worked, because current_app is a context-aware variable that is tied to the thread
-    that is handling the client request.
-    In a different thread, current_app would not have a value assigned.
-    Passing current_app directly as an argument to the thread object would not have worked either,
-    because current_app is really a proxy object that is dynamically mapped to the application instance.
-    So passing the proxy object would be the same as using current_app directly in the thread.
-    What I needed to do is access the real application instance that is stored inside the proxy object,
-    and pass that as the app argument.
-    The current_app._get_current_object() expression extracts the actual application instance
-    from inside the proxy object, so that is what I passed to the thread as an argument.
+    Emails are not delivered from the thread that is handling the client request.
+    Instead, send_email() builds the message and puts it on a queue that is stored
+    in the application instance, and a single long-lived background thread,
+    started by the application factory, takes messages from the queue and delivers them.
+    This avoids paying the cost of starting a new thread for every email, and
+    serializes the SMTP traffic when many emails are sent in a short period of time.
+    The worker also reuses the same SMTP connection for consecutive emails.
+    The worker thread needs the real application instance, not the current_app proxy,
+    because current_app is a context-aware variable that is tied to the thread
+    that is handling the client request. In a different thread, current_app
+    would not have a value assigned. For this reason the application factory
+    passes the app object itself to start_mail_worker().
 Usage:
     - send_email(subject, sender, recipients, text_body, html_body): Send an email asynchronously.
-    - send_async_email(app, msg): Helper function to send email in a background thread.
+    - start_mail_worker(app): Create the mail queue and start the background worker thread.
 """
 
+from queue import Queue, Empty, Full
 from threading import Thread
 from flask import current_app
 from flask_mail import Message
 from app import mail
 
+MAIL_QUEUE_SIZE = 10000
+MAIL_IDLE_TIMEOUT = 30
 
-def send_async_email(app, msg) -> None:
+
+def _close_connection(conn) -> None:
+    """
+    Close an SMTP connection, ignoring errors from a connection that is already broken.
+    :param conn: The Flask-Mail connection to close.
+    :return: None
+    """
+    try:
+        conn.__exit__(None, None, None)
+    except Exception:
+        pass
+
+
+def _mail_worker(app, mail_queue) -> None:
     """
-    Send an email in a background thread.
+    Deliver the emails that are put on the queue, forever.
+    The SMTP connection is kept open between messages, so that a burst of emails
+    pays for a single connection and TLS handshake. The connection is closed when
+    no email arrives for MAIL_IDLE_TIMEOUT seconds, or when sending fails. A
+    message that fails on a reused connection is sent again on a new one.
     :param app: The Flask application instance.
-    :param msg: The email message to send.
+    :param mail_queue: The queue the messages are taken from.
     :return: None
     """
     with app.app_context():
-        mail.send(msg)
+        conn = None
+        while True:
+            try:
+                msg = mail_queue.get(timeout=MAIL_IDLE_TIMEOUT)
+            except Empty:
+                if conn is not None:
+                    _close_connection(conn)
+                    conn = None
+                continue
+            # a connection that was already open may have been dropped by the
+            # server in the meantime, so a failure on it is retried once on a
+            # new connection
+            attempts = 2 if conn is not None else 1
+            try:
+                for attempt in range(attempts):
+                    try:
+                        if conn is None:
+                            conn = mail.connect().__enter__()
+                        conn.send(msg)
+                        break
+                    except Exception:
+                        if conn is not None:
+                            _close_connection(conn)
+                            conn = None
+                        if attempt == attempts - 1:
+                            app.logger.exception('Failed to send email')
+            finally:
+                mail_queue.task_done()
+
+
+def start_mail_worker(app) -> None:
+    """
+    Create the mail queue for the application and start the background
+    thread that delivers the queued emails.
+    :param app: The Flask application instance.
+    :return: None
+    """
+    mail_queue: Queue[Message] = Queue(maxsize=MAIL_QUEUE_SIZE)
+    app.extensions['mail_queue'] = mail_queue
+    Thread(target=_mail_worker, args=(app, mail_queue),
+           daemon=True).start()
 
 
 def send_email(subject, sender, recipients, text_body, html_body) -> None:
@@ -51,5 +110,8 @@ def send_email(subject, sender, recipients, text_body, html_body) -> None:
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email,
-           args=(current_app._get_current_object(), msg)).start() # pyright: ignore[reportAttributeAccessIssue]
+    try:
+        current_app.extensions['mail_queue'].put_nowait(msg)
+    except Full:
+        current_app.logger.error('Mail queue is full, dropping email to %s',
+                                 recipients)
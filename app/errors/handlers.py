@@ -5,15 +5,48 @@ Description:
     This module defines custom error handlers for the Flask application.
     It includes handlers for 404 (Not Found) and 500 (Internal Server Error) errors.
     The handlers render appropriate HTML templates and manage database sessions as needed.
+    The error pages only depend on the language and on the logged in user, who
+    appears in the navigation bar, so each page is rendered once for every
+    combination and then reused. Pages with flashed messages are always rendered.
 Usage:
     - not_found_error: Handles 404 errors by rendering a '404.html' template.
     - internal_error: Handles 500 errors by rolling back the database session and rendering a '500.html' template.
 """
 
-from flask import render_template
+from threading import Lock
+from flask import render_template, request, session
+from flask_babel import get_locale
+from flask_login import current_user
 from app import db
 from app.errors import bp
 
+# Rendered error pages, by status code, application root, language and user
+ERROR_PAGE_CACHE_SIZE = 1024
+_error_pages: dict[tuple, str] = {}
+_error_pages_lock = Lock()
+
+
+def render_error_page(template, status_code) -> str:
+    """
+    Render an error page, or return the copy rendered for an earlier error
+    with the same language and user.
+    :param template: The name of the template of the page.
+    :param status_code: The HTTP status code of the error.
+    :return: The HTML of the page.
+    """
+    if session.get('_flashes'):
+        return render_template(template)
+    key = (status_code, request.script_root, str(get_locale()),
+           current_user.get_id(), getattr(current_user, 'username', None))
+    html = _error_pages.get(key)
+    if html is None:
+        html = render_template(template)
+        with _error_pages_lock:
+            if len(_error_pages) >= ERROR_PAGE_CACHE_SIZE:
+                _error_pages.clear()
+            _error_pages[key] = html
+    return html
+
 
 @bp.app_errorhandler(404)
 def not_found_error(error):
@@ -22,7 +55,7 @@ def not_found_error(error):
     :param error: The error object representing the 404 error.
     :return: A tuple containing the rendered template and the 404 status code.
     """
-    return render_template('errors/404.html'), 404
+    return render_error_page('errors/404.html', 404), 404
 
 
 @bp.app_errorhandler(500)
@@ -34,4 +67,4 @@ def internal_error(error):
     :return: A tuple containing the rendered template and the 500 status code.
     """
     db.session.rollback()
-    return render_template('errors/500.html'), 500
+    return render_error_page('errors/500.html', 500), 500
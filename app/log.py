@@ -0,0 +1,130 @@
+"""
+Module name: log.py
+Author: Michele Grieco
+Description:
+    Logging helpers for the Flask application.
+    Log records are put on a queue by the request threads and written by a
+    listener thread. Instead of writing and flushing the log file once per record,
+    the listener collects the records that arrive within a short time window and
+    hands them to the handlers as a batch, so that a burst of log lines results in
+    a single write, a single flush and a single rollover check.
+Usage:
+    - BatchQueueListener: QueueListener that delivers records to its handlers in batches.
+    - BatchRotatingFileHandler: RotatingFileHandler that can write a batch of records at once,
+      and that checks for rollover less often when records are emitted one at a time.
+"""
+
+import time
+from logging.handlers import QueueListener, RotatingFileHandler
+from queue import Empty, Queue
+from typing import cast
+
+BATCH_SIZE = 256
+BATCH_WINDOW = 0.05
+ROLLOVER_CHECK_INTERVAL = 64
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    _records_since_check = 0
+
+    def shouldRollover(self, record) -> bool:
+        """
+        Determine if rollover should occur, checking the file only once every
+        ROLLOVER_CHECK_INTERVAL records, since each check stats the log file.
+        :param record: The log record about to be emitted.
+        :return: True if the file should be rolled over, False otherwise.
+        """
+        self._records_since_check += 1
+        if self._records_since_check < ROLLOVER_CHECK_INTERVAL:
+            return False
+        self._records_since_check = 0
+        return bool(super().shouldRollover(record))
+
+    def handle_batch(self, records) -> None:
+        """
+        Write a batch of records to the log file with a single write and flush.
+        The rollover check is done once for the whole batch.
+        :param records: The log records to write.
+        :return: None
+        """
+        records = [record for record in records if self.filter(record)]
+        if not records:
+            return
+        try:
+            text = ''.join(self.format(record) + self.terminator
+                           for record in records)
+        except Exception:
+            self.handleError(records[0])
+            return
+        with self.lock: # type: ignore[union-attr]
+            try:
+                if self.stream is None:
+                    self.stream = self._open()
+                if self.maxBytes > 0:
+                    self.stream.seek(0, 2)
+                    if self.stream.tell() and \
+                            self.stream.tell() + len(text) >= self.maxBytes:
+                        self.doRollover()
+                self.stream.write(text)
+                self.flush()
+            except Exception:
+                self.handleError(records[0])
+
+
+class BatchQueueListener(QueueListener):
+
+    def handle_batch(self, records) -> None:
+        """
+        Pass a batch of records to the handlers.
+        Handlers that implement handle_batch() receive the whole batch,
+        the others receive the records one at a time.
+        :param records: The log records to handle.
+        :return: None
+        """
+        records = [self.prepare(record) for record in records]
+        for handler in self.handlers:
+            if self.respect_handler_level:
+                accepted = [record for record in records
+                            if record.levelno >= handler.level]
+            else:
+                accepted = records
+            if hasattr(handler, 'handle_batch'):
+                handler.handle_batch(accepted)
+            else:
+                for record in accepted:
+                    handler.handle(record)
+
+    def _monitor(self) -> None:
+        """
+        Collect records from the queue in batches of up to BATCH_SIZE records,
+        waiting at most BATCH_WINDOW seconds after the first record of a batch,
+        and hand each batch to the handlers.
+        The thread terminates when it sees the sentinel object in the queue.
+        :return: None
+        """
+        q = cast(Queue, self.queue)
+        stop = False
+        while not stop:
+            batch = []
+            record = self.dequeue(True)
+            if record is self._sentinel: # type: ignore[attr-defined]
+                stop = True
+            else:
+                batch.append(record)
+                deadline = time.monotonic() + BATCH_WINDOW
+                while len(batch) < BATCH_SIZE:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        record = q.get(timeout=timeout)
+                    except Empty:
+                        break
+                    if record is self._sentinel: # type: ignore[attr-defined]
+                        stop = True
+                        break
+                    batch.append(record)
+            if batch:
+                self.handle_batch(batch)
+            for _ in range(len(batch) + stop):
+                q.task_done()
@@ -3,11 +3,23 @@ Module name: __init__.py
 Author: Michele Grieco
 Description:
     This module initializes the 'main' Blueprint for the Flask application.
-    It sets up the Blueprint and imports the routes defined in the 'routes' module.
+    It sets up the Blueprint. The routes defined in the 'routes' module are only
+    imported when the Blueprint is registered on an application by init_app(),
+    so importing this package does not load the views, forms and models they use.
+Usage:
+    - init_app(app): Import the routes and register the Blueprint on the application.
 """
 
 from flask import Blueprint
 
 bp = Blueprint('main', __name__)
 
-from app.main import routes
+
+def init_app(app) -> None:
+    """
+    Import the routes of the Blueprint and register it on the application.
+    :param app: The Flask application instance.
+    :return: None
+    """
+    from app.main import routes
+    app.register_blueprint(bp)
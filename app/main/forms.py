@@ -6,44 +6,75 @@ Author: Michele Grieco
 Description:
     This module defines various form classes used in the Flask application.
     It includes forms for editing profiles, submitting posts, searching, and more.
+Usage:
+    - get_empty_form(): Return the EmptyForm instance shared by the current request.
 """
 
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, TextAreaField
 from wtforms.validators import ValidationError, DataRequired, Length
 import sqlalchemy as sa
-from flask import request
+from flask import request, g
 from flask_babel import _, lazy_gettext as _l
 from app import db
 from app.models import User
 
+# Label shared by several forms, so that the lazy string is created only once
+SUBMIT_LABEL = _l('Submit')
+
 
 class EditProfileForm(FlaskForm):
-    username = StringField(_l('Username'), validators=[DataRequired()])
+    username = StringField(_l('Username'),
+                           validators=[DataRequired(), Length(max=64)])
     about_me = TextAreaField(_l('About me'),
                              validators=[Length(min=0, max=140)])
-    submit = SubmitField(_l('Submit'))
+    submit = SubmitField(SUBMIT_LABEL)
 
     def __init__(self, original_username, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.original_username = original_username
 
     def validate_username(self, username):
-        if username.data != self.original_username:
-            user = db.session.scalar(sa.select(User).where(
-                User.username == username.data))
-            if user is not None:
-                raise ValidationError(_('Please use a different username.'))
+        """
+        Validate that the new username is not used by another user.
+        Usernames are compared in lowercase, as the unique index of the user
+        table does, so changing only the case of the current username does not
+        need a database query. Neither does a username that already failed the
+        field validators.
+        :param username: The username field to validate.
+        :raise ValidationError: If the username is already taken.
+        :return: None
+        """
+        if username.errors:
+            return
+        if username.data.lower() == (self.original_username or '').lower():
+            return
+        taken = db.session.scalar(sa.select(sa.exists().where(
+            sa.func.lower(User.username) == username.data.lower())))
+        if taken:
+            raise ValidationError(_('Please use a different username.'))
 
 
 class EmptyForm(FlaskForm):
     submit = SubmitField('Submit')
 
 
+def get_empty_form() -> EmptyForm:
+    """
+    Return the EmptyForm of the current request, creating it the first time.
+    The form has no data of its own, so a single instance can be shared by all
+    the follow and unfollow buttons rendered in a request.
+    :return: The EmptyForm instance.
+    """
+    if '_empty_form' not in g:
+        g._empty_form = EmptyForm()
+    return g._empty_form
+
+
 class PostForm(FlaskForm):
     post = TextAreaField(_l('Say something'), validators=[
         DataRequired(), Length(min=1, max=140)])
-    submit = SubmitField(_l('Submit'))
+    submit = SubmitField(SUBMIT_LABEL)
 
 
 class SearchForm(FlaskForm):
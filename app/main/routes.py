@@ -18,33 +18,189 @@ Usage:
     - unfollow: Allows users to unfollow another user.
     - translate_text: Translates text from one language to another using a translation service.
     - search: Allows users to search for posts containing specific keywords.
+    - conditional_page(render, *state): Render a page, or answer 304 Not Modified if the browser has it.
+    - cached_url_for(endpoint, **values): url_for() that remembers the URLs built in the current request.
+    - paginate_posts(query, endpoint, **values): Return a page of posts and the links to the
+      newer and older pages, using keyset pagination.
 """
 
 from datetime import datetime, timezone
+from hashlib import sha1
+from time import time
 from flask import render_template, flash, redirect, url_for, request, g, \
-    current_app
+    current_app, abort, make_response, session
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
 from langdetect import detect, LangDetectException
 from app import db
-from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
-from app.models import User, Post
-from app.translate import translate
+from app.main.forms import EditProfileForm, PostForm, SearchForm, \
+    get_empty_form
+from app.models import User, Post, forget_user_lookups
+from app.cache import get_page, set_page
+from app.translate import translate, translate_many
 from app.main import bp
 
 
+# Pages served with an ETag are also considered changed after this many
+# seconds, which bounds how long details that are not part of the ETag, such
+# as the names of the authors of the posts, can be stale in the browser
+ETAG_PERIOD = 3600
+
+
+def conditional_page(render, *state):
+    """
+    Render a page with an ETag built from the state the page depends on, or
+    answer 304 Not Modified without rendering it when the browser sends the
+    same ETag. The state of the page is combined with the logged in user and
+    the username shown in the navigation bar, the locale and the full URL. Pages that have flashed messages to show are
+    always rendered.
+    The browser is asked to revalidate the page on every use, so that it never
+    shows a page that is out of date after the user follows or posts.
+    Rendered pages are also kept in the Redis cache for a short time, so that a
+    browser without the page, or another worker, gets it without rendering it
+    again. The cache key adds the CSRF token of the session to the ETag, since
+    the forms of the page embed it.
+    :param render: A function that renders the page.
+    :param state: The values that change when the content of the page changes.
+    :return: The response object.
+    """
+    if request.method != 'GET' or session.get('_flashes'):
+        return render()
+    key = (current_user.get_id(), getattr(current_user, 'username', None),
+           g.locale, request.full_path, int(time() // ETAG_PERIOD), *state)
+    etag = sha1(repr(key).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        csrf_token = session.get('csrf_token')
+        page_key = f'{etag}:{csrf_token}'
+        html = get_page(page_key) if csrf_token else None
+        if html is None:
+            html = render()
+            if csrf_token:
+                set_page(page_key, html)
+        response = make_response(html)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@bp.app_template_global()
+def cached_url_for(endpoint, **values) -> str:
+    """
+    Build a URL like url_for(), remembering the URLs built during the current
+    request. Pages of posts link to the same few authors many times, and each
+    of those links would otherwise run the URL builder again.
+    :param endpoint: The endpoint of the URL.
+    :param values: The arguments of the endpoint.
+    :return: The URL.
+    """
+    cache = g.setdefault('_url_cache', {})
+    key = (endpoint, *sorted(values.items()))
+    url = cache.get(key)
+    if url is None:
+        url = cache[key] = url_for(endpoint, **values)
+    return url
+
+
+def post_cursor(post) -> str:
+    """
+    Build the pagination cursor that points at a post.
+    :param post: The Post object.
+    :return: The cursor, made of the timestamp and the id of the post.
+    """
+    return f'{post.timestamp.isoformat()}_{post.id}'
+
+
+def parse_cursor(cursor) -> tuple[datetime, int] | None:
+    """
+    Parse a pagination cursor built by post_cursor().
+    :param cursor: The cursor given in the query string, or None.
+    :return: The timestamp and the id of the post, or None if the cursor is
+    missing or not valid.
+    """
+    if not cursor:
+        return None
+    timestamp, _sep, id = cursor.rpartition('_')
+    try:
+        return datetime.fromisoformat(timestamp), int(id)
+    except ValueError:
+        return None
+
+
+def paginate_posts(query, endpoint, **values) -> tuple[list, str | None,
+                                                       str | None]:
+    """
+    Return a page of the posts selected by a query, newest first.
+    Pages are located with the timestamp and the id of the last post of the
+    previous page (the before argument) or of the first post of the next page
+    (the after argument), instead of with an offset, so that reading a deep
+    page is an index seek and does not need to skip all the posts before it.
+    :param query: The query that selects the posts.
+    :param endpoint: The endpoint of the view, used to build the page links.
+    :param values: The other arguments of the endpoint.
+    :return: The posts, and the URLs of the older and of the newer pages, or
+    None when there is no such page.
+    """
+    per_page = current_app.config['POSTS_PER_PAGE']
+    before = parse_cursor(request.args.get('before'))
+    after = parse_cursor(request.args.get('after')) if before is None else None
+    query = query.order_by(None)
+    if after is not None:
+        timestamp, id = after
+        query = query.where(sa.or_(
+            Post.timestamp > timestamp,
+            sa.and_(Post.timestamp == timestamp, Post.id > id),
+        )).order_by(Post.timestamp, Post.id)
+    else:
+        if before is not None:
+            timestamp, id = before
+            query = query.where(sa.or_(
+                Post.timestamp < timestamp,
+                sa.and_(Post.timestamp == timestamp, Post.id < id),
+            ))
+        query = query.order_by(Post.timestamp.desc(), Post.id.desc())
+    posts = db.session.scalars(query.limit(per_page + 1)).all()
+    more = len(posts) > per_page
+    posts = posts[:per_page]
+    if after is not None:
+        posts.reverse()
+        has_newer, has_older = more, True
+    else:
+        has_newer, has_older = before is not None, more
+    if not posts:
+        return posts, None, None
+    next_url = url_for(endpoint, before=post_cursor(posts[-1]), **values) \
+        if has_older else None
+    prev_url = url_for(endpoint, after=post_cursor(posts[0]), **values) \
+        if has_newer else None
+    return posts, next_url, prev_url
+
+
 @bp.before_app_request
 def before_request():
     """
     Function to be executed before each request.
     Updates the last seen time for authenticated users and sets up the search form.
+    The last seen time is only written when the stored one is older than
+    LAST_SEEN_UPDATE_INTERVAL seconds, so that most requests don't write to
+    the database.
     Also sets the locale for the current request.
     :return: None
     """
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        now = datetime.now(timezone.utc)
+        last_seen = current_user.last_seen
+        if last_seen is not None and last_seen.tzinfo is None:
+            # SQLite does not store the timezone
+            last_seen = last_seen.replace(tzinfo=timezone.utc)
+        if last_seen is None or (now - last_seen).total_seconds() > \
+                current_app.config['LAST_SEEN_UPDATE_INTERVAL']:
+            current_user.last_seen = now
+            db.session.commit()
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -70,16 +226,10 @@ def index():
         db.session.commit()
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = paginate_posts(
+        current_user.following_posts(), 'main.index')
     return render_template('index.html', title=_('Home'), form=form,
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
@@ -89,20 +239,18 @@ def explore():
     """
     Explore page route.
     Displays a page with all posts in the system.
+    The page only changes when a new post is written.
     :return: Rendered template for the explore page.
     """
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template('index.html', title=_('Explore'),
-                           posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
+    def render():
+        posts, next_url, prev_url = paginate_posts(sa.select(Post),
+                                                   'main.explore')
+        return render_template('index.html', title=_('Explore'),
+                               posts=posts, next_url=next_url,
+                               prev_url=prev_url)
+
+    latest = db.session.scalar(sa.select(sa.func.max(Post.id)))
+    return conditional_page(render, latest)
 
 
 @bp.route('/user/<username>')
@@ -111,22 +259,29 @@ def user(username):
     """
     User profile page route.
     Displays a user's profile and their posts.
+    The page only changes when the user's profile, follow counts or posts
+    change, or when the logged in user follows or unfollows the user.
     :param username: The username of the user whose profile is to be displayed.
     :return: Rendered template for the user profile page.
     """
-    user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.user', username=user.username,
-                       page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username,
-                       page=posts.prev_num) if posts.has_prev else None
-    form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url, form=form)
+    user = User.get_by_username(username)
+    if user is None:
+        abort(404)
+
+    def render():
+        posts, next_url, prev_url = paginate_posts(
+            user.posts.select(), 'main.user', username=user.username)
+        form = get_empty_form()
+        return render_template('user.html', user=user, posts=posts,
+                               next_url=next_url, prev_url=prev_url,
+                               form=form)
+
+    latest = db.session.scalar(sa.select(sa.func.max(Post.id)).where(
+        Post.user_id == user.id))
+    return conditional_page(
+        render, user.id, user.username, user.about_me, user.last_seen,
+        user.follower_count, user.followed_count,
+        current_user.is_following(user), latest)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -135,13 +290,25 @@ def edit_profile():
     """
     Edit profile page route.
     Allows users to edit their profile information.
+    Submitting the form without changes does not write to the database.
     :return: Rendered template for the edit profile page.
     """
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
-        current_user.username = form.username.data
-        current_user.about_me = form.about_me.data
-        db.session.commit()
+        if current_user.username != form.username.data or \
+                current_user.about_me != form.about_me.data:
+            current_user.username = form.username.data
+            current_user.about_me = form.about_me.data
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # another user took the username after the form was validated
+                db.session.rollback()
+                form.username.errors.append(
+                    _('Please use a different username.'))
+                return render_template('edit_profile.html',
+                                       title=_('Edit Profile'), form=form)
+            forget_user_lookups()
         flash(_('Your changes have been saved.'))
         return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
@@ -160,17 +327,16 @@ def follow(username):
     :param username: The username of the user to follow.
     :return: Redirects to the followed user's profile page or the index page.
     """
-    form = EmptyForm()
+    form = get_empty_form()
     if form.validate_on_submit():
-        user = db.session.scalar(
-            sa.select(User).where(User.username == username))
-        if user is None:
+        user_id = User.get_id_by_username(username)
+        if user_id is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
-        if user == current_user:
+        if user_id == current_user.id:
             flash(_('You cannot follow yourself!'))
             return redirect(url_for('main.user', username=username))
-        current_user.follow(user)
+        current_user.follow_id(user_id)
         db.session.commit()
         flash(_('You are following %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
@@ -187,17 +353,16 @@ def unfollow(username):
     :param username: The username of the user to unfollow.
     :return: Redirects to the unfollowed user's profile page or the index page.
     """
-    form = EmptyForm()
+    form = get_empty_form()
     if form.validate_on_submit():
-        user = db.session.scalar(
-            sa.select(User).where(User.username == username))
-        if user is None:
+        user_id = User.get_id_by_username(username)
+        if user_id is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
-        if user == current_user:
+        if user_id == current_user.id:
             flash(_('You cannot unfollow yourself!'))
             return redirect(url_for('main.user', username=username))
-        current_user.unfollow(user)
+        current_user.unfollow_id(user_id)
         db.session.commit()
         flash(_('You are not following %(username)s.', username=username))
         return redirect(url_for('main.user', username=username))
@@ -211,9 +376,15 @@ def translate_text():
     """
     Translate text route.
     Translates text from one language to another using a translation service.
-    :return: A JSON response containing the translated text.
+    Instead of a single text, the request can send a list of texts, which are
+    translated with a single request to the translation service.
+    :return: A JSON response containing the translated text, or the list of translated texts.
     """
     data = request.get_json()
+    if 'texts' in data:
+        return {'texts': translate_many([(text, data['source_language'],
+                                          data['dest_language'])
+                                         for text in data['texts']])}
     return {'text': translate(data['text'],
                               data['source_language'],
                               data['dest_language'])}
@@ -230,7 +401,9 @@ def search():
         return redirect(url_for('main.explore'))
     page = request.args.get('page', 1, type=int)
     posts, total = Post.search(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE']) # type: ignore
-    next_url = url_for('main.search', q=g.search_form.q.data, page = page + 1) if total > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page = page - 1) if page > 1 else None
+    # both links only differ in the page number, so the URL is built once
+    base_url = url_for('main.search', q=g.search_form.q.data)
+    next_url = f'{base_url}&page={page + 1}' if total > page * current_app.config['POSTS_PER_PAGE'] else None
+    prev_url = f'{base_url}&page={page - 1}' if page > 1 else None
     return render_template('search.html', title=_('Search'), posts=posts,
                            next_url=next_url, prev_url=prev_url)
\ No newline at end of file
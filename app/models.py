@@ -17,17 +17,26 @@ Usage:
 """
 
 from datetime import datetime, timezone
-from hashlib import md5
+from functools import lru_cache
+from hashlib import md5, sha256
+from threading import Lock
 from time import time
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
-from flask import current_app
-from flask_login import UserMixin
+from sqlalchemy.dialects import postgresql, sqlite
+from flask import current_app, g, has_request_context
+from flask_login import UserMixin, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import InvalidHashError, VerificationError
+except ImportError: # argon2-cffi is not installed
+    PasswordHasher = None
 import jwt
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import add_many_to_index, create_index, query_index, \
+    update_index, REINDEX_BATCH_SIZE
 
 class SearchableMixin:
     
@@ -66,53 +75,166 @@ class SearchableMixin:
     def after_commit(cls, session):
         """
         Process changes after the commit to update the search index.
+        All the changes are sent to Elasticsearch in a single bulk request.
         :param session: The database session.
         :return: None
         """
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+        changes = session._changes
+        update_index(
+            [obj for obj in changes['add'] + changes['update']
+             if isinstance(obj, SearchableMixin)],
+            [obj for obj in changes['delete']
+             if isinstance(obj, SearchableMixin)])
         session._changes = None
         
     @classmethod
     def reindex(cls):
         """
         Reindex all records of the model.
+        The index is created again, so that it has the current mappings. The records are read from the database and sent to Elasticsearch
+        in batches, using the bulk API.
         :return: None
         """
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+        create_index(cls.__tablename__, cls.__searchable__)
+        query = sa.select(cls).execution_options(yield_per=REINDEX_BATCH_SIZE)
+        add_many_to_index(cls.__tablename__, db.session.scalars(query))
 
 # Set up event listeners to handle before and after commit events
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
+# Argon2id hasher for the passwords; when argon2-cffi is not installed the
+# passwords are hashed with the default method of Werkzeug
+password_hasher = PasswordHasher(
+    time_cost=3, memory_cost=65536, parallelism=2) if PasswordHasher else None
+
+
+def hash_password(password) -> str:
+    """
+    Hash a password with Argon2id, or with Werkzeug if Argon2 is not available.
+    :param password: The plaintext password.
+    :return: The password hash.
+    """
+    if password_hasher is None:
+        return generate_password_hash(password)
+    return password_hasher.hash(password)
+
+
+@lru_cache(maxsize=None)
+def dummy_password_hash() -> str:
+    """
+    Return the hash that is checked when there is no real hash to check, so that
+    a failed login takes the same time whether or not the user exists and has
+    a password.
+    The hash is generated on first use because hashing is slow on purpose,
+    and doing it at import time would slow down the application startup.
+    :return: The password hash.
+    """
+    return hash_password('dummy-password')
+
+
+def verify_password(password_hash, password) -> bool:
+    """
+    Check a password against a hash made by hash_password(), or by Werkzeug
+    for the users that have not logged in since Argon2 was adopted.
+    :param password_hash: The stored password hash.
+    :param password: The plaintext password to check.
+    :return: True if the password matches, False otherwise.
+    """
+    if not password_hash.startswith('$argon2'):
+        return check_password_hash(password_hash, password)
+    if password_hasher is None:
+        return False
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def password_needs_rehash(password_hash) -> bool:
+    """
+    Determine if a password hash was made with another scheme or with other
+    parameters than the ones hash_password() uses now.
+    :param password_hash: The stored password hash.
+    :return: True if the password should be hashed again, False otherwise.
+    """
+    if password_hasher is None:
+        return False
+    return not password_hash.startswith('$argon2') or \
+        password_hasher.check_needs_rehash(password_hash)
+
+
 # Association table for followers relationship
+
+# Insert constructs of the databases that can ignore a conflicting row
+_INSERT_IGNORE = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
 followers = sa.Table(
     'followers',
     db.metadata,
     sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'),
               primary_key=True),
     sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'),
-              primary_key=True)
+              primary_key=True),
+    # The primary key starts with follower_id, so lookups by the followed
+    # user need their own index
+    sa.Index('ix_followers_followed_id', 'followed_id')
 )
 
+
+@lru_cache(maxsize=4096)
+def gravatar_digest(email) -> str:
+    """
+    Compute the Gravatar hash of an email address.
+    The digests are cached, since the avatars of the same users are shown
+    many times on every page.
+    :param email: The email address, already lowercase as User stores it.
+    :return: The hexadecimal MD5 digest of the address.
+    """
+    return md5(email.encode('utf-8'), usedforsecurity=False).hexdigest()
+
+
+@lru_cache(maxsize=8192)
+def gravatar_url(email, size) -> str:
+    """
+    Build the Gravatar URL of an email address at the given size.
+    Avatars are shown at a few fixed sizes, so the URLs are cached as well.
+    :param email: The email address, already lowercase as User stores it.
+    :param size: The size of the avatar in pixels.
+    :return: The URL of the Gravatar.
+    """
+    digest = gravatar_digest(email)
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+
 class User(UserMixin, db.Model):
+    # Usernames are unique regardless of case; the functional index also
+    # serves the case-insensitive username lookups
+    __table_args__ = (
+        sa.Index('ix_user_username_lower', sa.func.lower(sa.text('username')),
+                 unique=True),
+    )
+
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     username: so.Mapped[str] = so.mapped_column(sa.String(64), index=True,
                                                 unique=True)
     email: so.Mapped[str] = so.mapped_column(sa.String(120), index=True,
                                              unique=True)
-    password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
+    # Only needed to log in, so it is not loaded with the rest of the row
+    password_hash: so.Mapped[Optional[str]] = so.mapped_column(
+        sa.String(256), deferred=True)
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(
         default=lambda: datetime.now(timezone.utc))
+    # Number of followers and of followed users, kept up to date by follow()
+    # and unfollow() so that profile pages don't need to count them
+    follower_count: so.Mapped[int] = so.mapped_column(default=0,
+                                                      server_default='0')
+    followed_count: so.Mapped[int] = so.mapped_column(default=0,
+                                                      server_default='0')
 
     posts: so.WriteOnlyMapped['Post'] = so.relationship(
         back_populates='author')
@@ -125,12 +247,23 @@ class User(UserMixin, db.Model):
         secondaryjoin=(followers.c.follower_id == id),
         back_populates='following')
 
+    @so.validates('email')
+    def normalize_email(self, key, email) -> str:
+        """
+        Store email addresses in lowercase and without surrounding spaces,
+        so that they can be compared with the plain unique index.
+        :param key: The name of the attribute being set.
+        :param email: The email address.
+        :return: The normalized email address.
+        """
+        return email.strip().lower() if email is not None else email
+
     def __repr__(self) -> str:
         """
         String representation of the User object.
         :return: A string representing the user.
         """
-        return '<User {}>'.format(self.username)
+        return f'<User {self.username}>'
 
     def set_password(self, password) -> None:
         """
@@ -138,15 +271,43 @@ class User(UserMixin, db.Model):
         :param password: The plaintext password to hash and set.
         :return: None
         """
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password) -> bool:
         """
         Check if the provided password matches the stored password hash.
+        When the password matches a hash made with an older scheme or with
+        weaker parameters, the hash is replaced with a new one; the caller
+        must commit the session for the new hash to be saved.
+        When USE_VERIFY_PASSWORD_CACHE is enabled, successful checks are
+        remembered for a few minutes, so that clients that send the same
+        credentials repeatedly don't pay for the password hash every time.
+        Failed checks are never remembered.
         :param password: The plaintext password to check.
         :return: True if the password matches, False otherwise.
         """
-        return check_password_hash(self.password_hash, password) # type: ignore
+        if password is None:
+            return False
+        if self.password_hash is None:
+            verify_password(dummy_password_hash(), password)
+            return False
+        use_cache = current_app.config['USE_VERIFY_PASSWORD_CACHE']
+        if use_cache:
+            key = sha256(f'{self.password_hash}\0{password}'.encode('utf-8')).digest()
+            with _verified_passwords_lock:
+                expires = _verified_passwords.get(key)
+            if expires is not None and expires > time():
+                return True
+        if not verify_password(self.password_hash, password):
+            return False
+        if password_needs_rehash(self.password_hash):
+            self.set_password(password)
+        elif use_cache:
+            with _verified_passwords_lock:
+                if len(_verified_passwords) >= PASSWORD_CACHE_SIZE:
+                    _verified_passwords.clear()
+                _verified_passwords[key] = time() + PASSWORD_CACHE_TTL
+        return True
 
     def avatar(self, size) -> str:
         """
@@ -154,8 +315,7 @@ class User(UserMixin, db.Model):
         :param size: The size of the avatar in pixels.
         :return: The URL of the user's Gravatar.
         """
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return gravatar_url(self.email, size)
 
     def follow(self, user) -> None:
         """
@@ -163,8 +323,56 @@ class User(UserMixin, db.Model):
         :param user: The User object to follow.
         :return: None
         """
-        if not self.is_following(user):
-            self.following.add(user)
+        self.follow_id(user.id)
+
+    def follow_id(self, user_id) -> None:
+        """
+        Follow another user given its id, without loading it.
+        On databases that support it, the row is inserted with a single
+        statement that does nothing when the user is already followed.
+        The follow counts of both users are updated in the same transaction.
+        :param user_id: The id of the user to follow.
+        :return: None
+        """
+        dialect = db.session.get_bind().dialect.name
+        if dialect in _INSERT_IGNORE:
+            result = db.session.execute(_INSERT_IGNORE[dialect](followers).values(
+                follower_id=self.id, followed_id=user_id
+            ).on_conflict_do_nothing())
+            added = result.rowcount > 0
+        else:
+            added = not db.session.scalar(sa.select(sa.exists().where(
+                followers.c.follower_id == self.id,
+                followers.c.followed_id == user_id)))
+            if added:
+                db.session.execute(followers.insert().values(
+                    follower_id=self.id, followed_id=user_id))
+        if added:
+            self._update_follow_counts([user_id], 1)
+
+    def follow_many(self, users) -> None:
+        """
+        Follow several users at once.
+        On databases that support it, all the rows are inserted with a single
+        statement that skips the users that are already followed, and the
+        follow counts are updated with two more statements.
+        :param users: The User objects to follow.
+        :return: None
+        """
+        ids = list(dict.fromkeys(user.id for user in users))
+        if not ids:
+            return
+        dialect = db.session.get_bind().dialect.name
+        if dialect not in _INSERT_IGNORE:
+            for id in ids:
+                self.follow_id(id)
+            return
+        result = db.session.execute(_INSERT_IGNORE[dialect](followers).values(
+            [{'follower_id': self.id, 'followed_id': id} for id in ids]
+        ).on_conflict_do_nothing().returning(followers.c.followed_id))
+        added = result.scalars().all()
+        if added:
+            self._update_follow_counts(added, 1)
 
     def unfollow(self, user) -> None:
         """
@@ -172,8 +380,35 @@ class User(UserMixin, db.Model):
         :param user: The User object to unfollow.
         :return: None
         """
-        if self.is_following(user):
-            self.following.remove(user)
+        self.unfollow_id(user.id)
+
+    def unfollow_id(self, user_id) -> None:
+        """
+        Unfollow another user given its id, without loading it.
+        The row is deleted with a single statement, which does nothing when
+        the user is not followed, so no check is needed first.
+        :param user_id: The id of the user to unfollow.
+        :return: None
+        """
+        result = db.session.execute(followers.delete().where(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user_id))
+        if result.rowcount > 0:
+            self._update_follow_counts([user_id], -1)
+
+    def _update_follow_counts(self, ids, delta) -> None:
+        """
+        Change the follow counts of this user and of the users it follows.
+        The counts are updated in the database, so that concurrent changes
+        are not lost, and in the objects already loaded in the session.
+        :param ids: The ids of the users that are followed or unfollowed.
+        :param delta: 1 for a follow, -1 for an unfollow.
+        :return: None
+        """
+        db.session.execute(sa.update(User).where(User.id == self.id).values(
+            followed_count=User.followed_count + delta * len(ids)))
+        db.session.execute(sa.update(User).where(User.id.in_(ids)).values(
+            follower_count=User.follower_count + delta))
 
     def is_following(self, user) -> bool:
         """
@@ -181,46 +416,38 @@ class User(UserMixin, db.Model):
         :param user: The User object to check.
         :return: True if the user is following the other user, False otherwise.
         """
-        query = self.following.select().where(User.id == user.id)
-        return db.session.scalar(query) is not None
+        query = sa.select(sa.exists().where(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id))
+        return db.session.scalar(query)
 
     def followers_count(self) -> Optional[int]:
         """
-        Count the number of followers the user has.
+        Return the number of followers the user has.
         :return: The number of followers.
         """
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.follower_count
 
     def following_count(self) -> Optional[int]:
         """
-        Count the number of users the user is following.
+        Return the number of users the user is following.
         :return: The number of users being followed.
         """
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.followed_count
 
     def following_posts(self):
         """
         Retrieve posts from users that the current user is following,
         as well as the user's own posts, ordered by timestamp descending.
+        Only the filter on the user is added here; the rest of the query is
+        built once by _following_posts_query().
         :return: A query object for the posts.
         """
-        Author = so.aliased(User)
-        Follower = so.aliased(User)
-        return (
-            sa.select(Post)
-            .join(Post.author.of_type(Author))
-            .join(Author.followers.of_type(Follower), isouter=True)
-            .where(sa.or_(
-                Follower.id == self.id,
-                Author.id == self.id,
-            ))
-            .group_by(Post) # type: ignore
-            .order_by(Post.timestamp.desc())
-        )
+        query, Author, Follower = _following_posts_query()
+        return query.where(sa.or_(
+            Follower.id == self.id,
+            Author.id == self.id,
+        ))
 
     def get_reset_password_token(self, expires_in=600) -> str:
         """
@@ -232,47 +459,219 @@ class User(UserMixin, db.Model):
             {'reset_password': self.id, 'exp': time() + expires_in},
             current_app.config['SECRET_KEY'], algorithm='HS256')
 
+    @staticmethod
+    def get_by_username(username) -> Optional['User']:
+        """
+        Look up a user by username, remembering the result for the current request.
+        :param username: The username to look for.
+        :return: The User object if found, None otherwise.
+        """
+        return _get_user_by('username', username)
+
+    @staticmethod
+    def create(username, email, password) -> None:
+        """
+        Add a new user with a single INSERT statement, without creating a User
+        object in the session. The email is normalized like normalize_email()
+        does for User objects.
+        :param username: The username of the new user.
+        :param email: The email address of the new user.
+        :param password: The plaintext password of the new user.
+        :return: None
+        """
+        db.session.execute(sa.insert(User).values(
+            username=username, email=email.strip().lower(),
+            password_hash=hash_password(password)))
+
+    @staticmethod
+    def get_for_login(username) -> Optional['User']:
+        """
+        Look up a user by username, loading the password hash with the rest
+        of the row, since it is going to be checked.
+        :param username: The username to look for.
+        :return: The User object if found, None otherwise.
+        """
+        return db.session.scalar(_user_for_login_query(), {'value': username})
+
+    @staticmethod
+    def get_id_by_username(username) -> Optional[int]:
+        """
+        Look up the id of a user by username, without loading the user.
+        :param username: The username to look for.
+        :return: The id of the user if found, None otherwise.
+        """
+        return db.session.scalar(_USER_ID_BY_USERNAME, {'value': username})
+
+    @staticmethod
+    def get_by_email(email) -> Optional['User']:
+        """
+        Look up a user by email, remembering the result for the current request.
+        Emails are stored normalized, so the address is normalized the same way.
+        :param email: The email address to look for.
+        :return: The User object if found, None otherwise.
+        """
+        return _get_user_by('email', email.strip().lower())
+
     @staticmethod
     def verify_reset_password_token(token) -> Optional['User']:
         """
         Verify a JWT token for password reset and return the corresponding user.
+        Valid tokens are remembered for a short time, so following the same reset
+        link again does not verify and decode the token again. Only the user id
+        is remembered; the user is always loaded from the database.
         :param token: The JWT token to verify.
         :return: The User object if the token is valid, None otherwise.
         """
-        try:
-            id = jwt.decode(token, current_app.config['SECRET_KEY'],
-                            algorithms=['HS256'])['reset_password']
-        except Exception:
-            return
+        secret_key = current_app.config['SECRET_KEY']
+        key = sha256(f'{secret_key}\0{token}'.encode('utf-8')).digest()
+        cached = _reset_tokens.get(key)
+        if cached is not None and cached[1] > time():
+            id = cached[0]
+        else:
+            try:
+                payload = jwt.decode(token, secret_key, algorithms=['HS256'])
+                id = payload['reset_password']
+            except Exception:
+                return
+            if len(_reset_tokens) >= RESET_TOKEN_CACHE_SIZE:
+                _reset_tokens.clear()
+            _reset_tokens[key] = (
+                id, min(payload['exp'], time() + RESET_TOKEN_CACHE_TTL))
         return db.session.get(User, id)
 
 
+# Recently verified reset tokens, mapping a digest of the secret key and the
+# token to the user id and the time until which the entry can be used
+RESET_TOKEN_CACHE_SIZE = 1024
+RESET_TOKEN_CACHE_TTL = 60
+_reset_tokens = {}
+
+# Digests of recently verified password hash and password pairs, mapped to the
+# time until which the entry can be used
+PASSWORD_CACHE_SIZE = 4096
+PASSWORD_CACHE_TTL = 300
+_verified_passwords = {}
+_verified_passwords_lock = Lock()
+
+
+# User lookups built once at import time; the username and email columns are
+# unique and indexed, and SQLAlchemy reuses the compiled form of the statements.
+_USER_BY = {
+    'username': sa.select(User).where(User.username == sa.bindparam('value')),
+    'email': sa.select(User).where(User.email == sa.bindparam('value')),
+}
+_USER_ID_BY_USERNAME = sa.select(User.id).where(
+    User.username == sa.bindparam('value'))
+
+
+@lru_cache(maxsize=None)
+def _user_for_login_query():
+    """
+    Build the query that looks up a user by username together with its
+    password hash. Loader options need all the mappers to be configured, so
+    the query is built on first use rather than at import time like the
+    other user lookups.
+    :return: The query, with a 'value' parameter for the username.
+    """
+    return _USER_BY['username'].options(so.undefer(User.password_hash))
+
+
+def _get_user_by(column, value) -> Optional[User]:
+    """
+    Look up a user by the value of a unique column.
+    The result is remembered until the end of the request, so looking up the
+    same user again in the same request does not query the database.
+    The logged in user is already loaded by Flask-Login, so looking it up does
+    not query the database either.
+    :param column: The name of the column, 'username' or 'email'.
+    :param value: The value to look for.
+    :return: The User object if found, None otherwise.
+    """
+    cache = g.setdefault('_user_cache', {})
+    key = (column, value)
+    if key not in cache:
+        if has_request_context() and current_user.is_authenticated and \
+                getattr(current_user, column) == value:
+            cache[key] = current_user._get_current_object()
+            return cache[key]
+        cache[key] = db.session.scalar(_USER_BY[column], {'value': value})
+    return cache[key]
+
+
+def forget_user_lookups() -> None:
+    """
+    Discard the user lookups remembered for the current request.
+    This must be called after changing the username or the email of a user.
+    :return: None
+    """
+    g.pop('_user_cache', None)
+
+
 # Flask-Login user loader callback
 @login.user_loader
 def load_user(id) -> Optional[User]:
     """
     Load a user by ID for Flask-Login.
+    Relationships of the logged in user are never loaded implicitly; raising
+    an error instead makes an accidental lazy load on every request visible.
     :param id: The user ID.
     :return: The User object if found, None otherwise.
     """
-    return db.session.get(User, int(id))
+    try:
+        id = int(id)
+    except (TypeError, ValueError):
+        return None
+    return db.session.get(User, id, options=[so.raiseload('*')])
 
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    # The posts of an author, newest first, are read with a single backward
+    # range scan of this index; it also serves the lookups by user_id alone
+    __table_args__ = (
+        sa.Index('ix_post_user_timestamp', 'user_id', 'timestamp'),
+    )
+
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(
         index=True, default=lambda: datetime.now(timezone.utc))
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
-                                               index=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
 
-    author: so.Mapped[User] = so.relationship(back_populates='posts')
+    # Pages list many posts and show the author of each, so the authors of a
+    # page of posts are loaded together with a single extra query
+    author: so.Mapped[User] = so.relationship(back_populates='posts',
+                                              lazy='selectin')
 
     def __repr__(self) -> str:
         """
         String representation of the Post object.
+        Only the start of the body is shown, to keep log lines short.
         :return: A string representing the post.
         """
-        return '<Post {}>'.format(self.body)
+        return f'<Post {self.body[:40]!r}>'
+
+
+@lru_cache(maxsize=None)
+def _following_posts_query():
+    """
+    Build the part of the followed posts query that is the same for all users.
+    Creating the aliases and the joins is most of the cost of building the
+    query, so it is done only once. The aliases are named, so that the SQL in
+    the logs is readable. Only the author columns that the post template
+    shows are loaded.
+    :return: The query, and the aliases for the author and for the follower.
+    """
+    Author = so.aliased(User, name='author')
+    Follower = so.aliased(User, name='follower')
+    query = (
+        sa.select(Post)
+        .options(so.selectinload(Post.author).load_only(
+            User.username, User.email))
+        .join(Post.author.of_type(Author))
+        .join(Author.followers.of_type(Follower), isouter=True)
+        .group_by(Post) # type: ignore
+        .order_by(Post.timestamp.desc())
+    )
+    return query, Author, Follower
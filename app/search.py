@@ -6,13 +6,130 @@ Author: Michele Grieco
 Description:
     Elasticsearch integration for indexing and searching model instances.
 Usage:
+    - get_es(): Return the Elasticsearch client of the current app, creating it on first use.
+    - create_index(index, fields): Create the Elasticsearch index of a model, replacing an existing one.
+    - ensure_index(index, fields): Create the Elasticsearch index of a model if it does not exist.
     - add_to_index(index, model): Add a model instance to the Elasticsearch index.
+    - add_many_to_index(index, models): Add many model instances to the index with bulk requests.
+    - update_index(added, removed): Add and remove model instances with a single bulk request.
     - remove_from_index(index, model): Remove a model instance from the Elasticsearch index.
+    - has_search_field(es, index): Check if an index has the field that collects all the searchable fields.
     - query_index(index, query, page, per_page): Query the Elasticsearch index for a given search term.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import time
+from typing import TYPE_CHECKING
 from flask import current_app
 
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch
+
+# Number of documents sent in each bulk request when reindexing
+REINDEX_BATCH_SIZE = 500
+
+# Field that receives a copy of all the searchable fields of a document, so
+# that queries search a single field
+SEARCH_FIELD = 'search_text'
+
+# Seconds after which an index without SEARCH_FIELD is checked again
+SEARCH_FIELD_CHECK_INTERVAL = 60
+
+
+def get_es() -> 'Elasticsearch | None':
+    """
+    Return the Elasticsearch client of the current application.
+    The client is created the first time it is requested and then reused
+    for the lifetime of the application. Requests are compressed and have a
+    short timeout, so that a dead connection does not stall the request
+    that is using it. When orjson is installed, it is used to encode and
+    decode the JSON bodies, which is much faster than the json module. This
+    includes the lines of the NDJSON bodies of the bulk requests.
+    The elasticsearch package is only imported here, because importing it takes
+    a good part of the application startup time, and many processes, such as
+    the ones that run CLI commands, never use it.
+    :return: The Elasticsearch client, or None if ELASTICSEARCH_URL is not configured.
+    """
+    es = current_app.extensions.get('elasticsearch')
+    if es is None and current_app.config['ELASTICSEARCH_URL']:
+        from elasticsearch import Elasticsearch
+        try:
+            from elasticsearch.serializer import NdjsonSerializer, \
+                OrjsonSerializer
+        except ImportError: # orjson is not installed
+            serializers = None
+        else:
+            class OrjsonNdjsonSerializer(NdjsonSerializer):
+                json_dumps = OrjsonSerializer.json_dumps
+                json_loads = OrjsonSerializer.json_loads
+
+            serializers = {'application/json': OrjsonSerializer(),
+                           'application/x-ndjson': OrjsonNdjsonSerializer()}
+        es = Elasticsearch(
+            [current_app.config['ELASTICSEARCH_URL']],
+            http_compress=True,
+            request_timeout=5,
+            retry_on_timeout=True,
+            max_retries=2,
+            sniff_on_start=False,
+            sniff_on_node_failure=False,
+            connections_per_node=10,
+            serializers=serializers)
+        current_app.extensions['elasticsearch'] = es
+    return es
+
+
+def _index_mappings(fields) -> dict:
+    """
+    Build the mappings of an index, in which each searchable field is also
+    copied to SEARCH_FIELD.
+    :param fields: The names of the searchable fields of the model.
+    :return: The mappings.
+    """
+    properties = {field: {'type': 'text', 'copy_to': SEARCH_FIELD}
+                  for field in fields}
+    properties[SEARCH_FIELD] = {'type': 'text'}
+    return {'properties': properties}
+
+
+def create_index(index, fields) -> None:
+    """
+    Create the Elasticsearch index of a model, deleting the existing index
+    if there is one. This is done before reindexing the model, so that the
+    index always has the current mappings.
+    :param index: The name of the Elasticsearch index.
+    :param fields: The names of the searchable fields of the model.
+    :return: None
+    """
+    es = get_es()
+    if not es:
+        return
+    es.options(ignore_status=404).indices.delete(index=index)
+    es.indices.create(index=index, mappings=_index_mappings(fields))
+    current_app.extensions.setdefault('elasticsearch_indexes', set()).add(index)
+    current_app.extensions.setdefault('elasticsearch_search_field', {})[index] = True
+
+
+def ensure_index(es, index, fields) -> None:
+    """
+    Create the Elasticsearch index of a model if it does not exist yet, so
+    that it is not created by the first document with dynamic mappings.
+    The check is done once per index for the lifetime of the application.
+    :param es: The Elasticsearch client.
+    :param index: The name of the Elasticsearch index.
+    :param fields: The names of the searchable fields of the model.
+    :return: None
+    """
+    known = current_app.extensions.setdefault('elasticsearch_indexes', set())
+    if index in known:
+        return
+    if not es.indices.exists(index=index):
+        # another process may create the index at the same time
+        es.options(ignore_status=400).indices.create(
+            index=index, mappings=_index_mappings(fields))
+    known.add(index)
+
+
 def add_to_index(index, model) -> None:
     """
     Add a model instance to the Elasticsearch index.
@@ -21,12 +138,95 @@ def add_to_index(index, model) -> None:
     :param model: The model instance to index.
     :return: None
     """
-    if not current_app.elasticsearch:
+    es = get_es()
+    if not es:
         return
+    ensure_index(es, index, model.__searchable__)
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    es.index(index=index, id=model.id, document=payload)
+
+
+def add_many_to_index(index, models) -> None:
+    """
+    Add many model instances to the Elasticsearch index, as done when
+    reindexing a model, after creating the index with create_index(). The documents are sent with the bulk API in requests
+    of REINDEX_BATCH_SIZE documents, and the models are consumed as the
+    requests are sent, so they can come from a query that is read in batches.
+    :param index: The name of the Elasticsearch index.
+    :param models: An iterable with the model instances to index.
+    :return: None
+    """
+    es = get_es()
+    if not es:
+        return
+    from elasticsearch import helpers
+    actions = ({'_index': index, '_id': model.id,
+                '_source': {field: getattr(model, field)
+                            for field in model.__searchable__}}
+               for model in models)
+    for _ in helpers.streaming_bulk(es, actions, chunk_size=REINDEX_BATCH_SIZE,
+                                    refresh=False):
+        pass
+
+
+def update_index(added, removed) -> None:
+    """
+    Add and remove model instances from their Elasticsearch indexes using
+    the bulk API, so that all the changes are sent in a single request.
+    Each model is indexed in the index named after its table.
+    The documents are built right away, while the models can still be read,
+    and the indexes are created and the request is sent by a background
+    thread, so that the commit that triggers the update does not wait for
+    Elasticsearch. A single thread
+    sends the requests, so the changes reach the index in commit order.
+    :param added: The model instances to add or update.
+    :param removed: The model instances to remove.
+    :return: None
+    """
+    es = get_es()
+    if not es:
+        return
+    actions = [{'_op_type': 'index', '_index': model.__tablename__,
+                '_id': model.id,
+                '_source': {field: getattr(model, field)
+                            for field in model.__searchable__}}
+               for model in added]
+    actions += [{'_op_type': 'delete', '_index': model.__tablename__,
+                 '_id': model.id} for model in removed]
+    if actions:
+        indexes = {model.__tablename__: model.__searchable__
+                   for model in added}
+        executor = current_app.extensions.get('elasticsearch_executor')
+        if executor is None:
+            executor = current_app.extensions['elasticsearch_executor'] = \
+                ThreadPoolExecutor(max_workers=1,
+                                   thread_name_prefix='elasticsearch')
+        executor.submit(_send_bulk, current_app._get_current_object(), es,
+                        indexes, actions)
+
+
+def _send_bulk(app, es, indexes, actions) -> None:
+    """
+    Create the indexes that are missing and send bulk actions to
+    Elasticsearch, logging any error.
+    This runs in the background thread of update_index(), so that neither
+    step makes the commit wait for Elasticsearch.
+    :param app: The Flask application instance.
+    :param es: The Elasticsearch client.
+    :param indexes: The searchable fields of the models added, by index name.
+    :param actions: The bulk actions to send.
+    :return: None
+    """
+    from elasticsearch import helpers
+    with app.app_context():
+        try:
+            for index, fields in indexes.items():
+                ensure_index(es, index, fields)
+            helpers.bulk(es, actions, chunk_size=500, ignore_status=(404,))
+        except Exception:
+            app.logger.exception('Failed to update the search index')
 
 
 def remove_from_index(index, model) -> None:
@@ -36,26 +236,60 @@ def remove_from_index(index, model) -> None:
     :param model: The model instance to remove from the index.
     :return: None
     """
-    if not current_app.elasticsearch:
+    es = get_es()
+    if not es:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    es.delete(index=index, id=model.id)
+
+
+def has_search_field(es, index) -> bool:
+    """
+    Check if the mappings of an index have SEARCH_FIELD.
+    Indexes created before the field was introduced don't have it until the
+    model is reindexed. An index that has the field is not checked again; one
+    that doesn't is checked again after SEARCH_FIELD_CHECK_INTERVAL seconds, so
+    that a reindex done by another process is noticed.
+    :param es: The Elasticsearch client.
+    :param index: The name of the Elasticsearch index.
+    :return: True if the index has the field, False otherwise.
+    """
+    checked = current_app.extensions.setdefault('elasticsearch_search_field', {})
+    found = checked.get(index)
+    if found is True or (found is not None and found > time.monotonic()):
+        return found is True
+    mappings = es.options(ignore_status=404).indices.get_mapping(index=index)
+    found = any(SEARCH_FIELD in m.get('mappings', {}).get('properties', {})
+                for m in mappings.body.values()
+                if isinstance(m, dict))
+    checked[index] = True if found else \
+        time.monotonic() + SEARCH_FIELD_CHECK_INTERVAL
+    return found
 
 
 def query_index(index, query, page, per_page) -> tuple[list[int], int]:
     """
     Query the Elasticsearch index for a given search term.
+    Only SEARCH_FIELD is searched, since it has a copy of all the searchable fields.
+    Indexes that don't have the field yet are searched on all their fields.
+    Hits are only counted up to one past the end of the requested page, which
+    is enough to know if there is a next page and saves Elasticsearch from
+    counting all the matches of broad queries.
     :param index: The name of the Elasticsearch index.
     :param query: The search term.
     :param page: The page number for pagination.
     :param per_page: The number of results per page.
-    :return: A tuple containing a list of matching record IDs and the total number of matches
+    :return: A tuple containing a list of matching record IDs and the total number of matches,
+    which is capped at page * per_page + 1
     """
-    if not current_app.elasticsearch:
+    es = get_es()
+    if not es:
         return [], 0
-    search = current_app.elasticsearch.search(
+    search = es.search(
         index=index,
-        query={'multi_match': {'query': query, 'fields': ['*']}},
+        query={'match': {SEARCH_FIELD: query}} if has_search_field(es, index)
+        else {'multi_match': {'query': query, 'fields': ['*']}},
         from_=(page - 1) * per_page,
-        size=per_page)
+        size=per_page,
+        track_total_hits=page * per_page + 1)
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     return ids, search['hits']['total']['value']
\ No newline at end of file
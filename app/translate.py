@@ -5,13 +5,214 @@ Description:
     This module provides a function to translate text using the Microsoft Translator API.
     It checks for the presence of an API key in the application configuration and
     handles errors gracefully by returning appropriate messages.
+    All the requests go through a module-level session with a pooled HTTPS adapter,
+    so consecutive translations reuse the keep-alive connection to the service
+    instead of paying for a new TCP and TLS handshake every time.
+    Translations are cached in two tiers: an LRU cache in the process, and Redis,
+    which is shared by all the worker processes and survives restarts. Redis is
+    optional; when REDIS_URL is not configured, the redis package is not installed
+    or the server does not respond, only the process cache is used.
+    Many texts can be translated at once with translate_many(), which sends a
+    single request to the service for up to TRANSLATOR_BATCH_SIZE texts that
+    have the same source and destination languages. When more than one request
+    is needed, the requests are sent in parallel from a small pool of threads.
 Usage:
     - translate: Function to translate text from a source language to a destination language.
+    - translate_many(items): Translate a list of (text, source_language, dest_language) tuples.
+    - warm_up(app): Open a connection to the translation service in the background.
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+from functools import lru_cache
+from hashlib import blake2b
+from threading import Lock, Thread
 import requests
+from requests.adapters import HTTPAdapter # type: ignore[import-untyped]
+from urllib3.util import Retry
 from flask import current_app
 from flask_babel import _
+from app.cache import get_redis
+
+TRANSLATOR_HOST = 'https://api.cognitive.microsofttranslator.com/'
+TRANSLATOR_URL = 'https://api.cognitive.microsofttranslator.com/translate?api-version=3.0'
+TRANSLATOR_TIMEOUT = (3.05, 10)
+# Limits of a single request to the translation service
+TRANSLATOR_BATCH_SIZE = 100
+TRANSLATOR_BATCH_CHARS = 50000
+
+# Number of translations kept in the cache of each process
+TRANSLATION_CACHE_SIZE = 2048
+# Requests to the translation service sent in parallel by translate_many();
+# must not be larger than the connection pool of the session
+TRANSLATOR_WORKERS = 8
+
+# Cache of the translations in the process, in least recently used order;
+# shared by translate() and translate_many()
+_local_translations: OrderedDict[tuple[str, str, str], str] = OrderedDict()
+_local_translations_lock = Lock()
+
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+    pool_connections=10, pool_maxsize=20,
+    # the Retry-After header is ignored, since urllib3 would sleep for as
+    # long as the server asks; the backoff keeps the waits short instead
+    max_retries=Retry(total=3, connect=2, read=2, backoff_factor=0.2,
+                      backoff_max=1,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(['POST']),
+                      respect_retry_after_header=False)))
+_executor = ThreadPoolExecutor(max_workers=TRANSLATOR_WORKERS)
+
+
+class TranslationError(Exception):
+    """
+    Raised when the translation service does not return a translation.
+    Failures are raised rather than returned, so that they are not cached.
+    """
+
+
+@lru_cache(maxsize=4)
+def _auth_headers(key) -> dict:
+    """
+    Build the authentication and content headers of the requests to the
+    translation service. The headers only depend on the subscription key, so
+    they are built once and reused by all the requests.
+    :param key: The subscription key of the service.
+    :return: The headers. The dictionary is shared and must not be modified.
+    """
+    return {
+        'Ocp-Apim-Subscription-Key': key,
+        'Ocp-Apim-Subscription-Region': 'westus',
+        'Content-Type': 'application/json; charset=UTF-8'
+    }
+
+
+def _request_translations(texts, source_language, dest_language,
+                          key=None) -> list:
+    """
+    Translate a list of texts with a single request to the Microsoft Translator API.
+    :param texts: The texts to translate, at most TRANSLATOR_BATCH_SIZE.
+    :param source_language: The language code of the source texts.
+    :param dest_language: The language code to translate the texts into.
+    :param key: The subscription key of the service; by default the one of the current app, which must be given when there is no app context.
+    :raise TranslationError: If the request fails.
+    :return: The translated texts, in the same order.
+    """
+    auth = _auth_headers(key or current_app.config['MS_TRANSLATOR_KEY'])
+    try:
+        r = _session.post(
+            TRANSLATOR_URL,
+            params={'from': source_language, 'to': dest_language},
+            headers=auth,
+            # non-ASCII text is sent as UTF-8 rather than as \u escapes,
+            # which are two or three times longer
+            data=json.dumps([{'Text': text} for text in texts],
+                            ensure_ascii=False).encode('utf-8'),
+            timeout=TRANSLATOR_TIMEOUT)
+    except requests.RequestException as e:
+        raise TranslationError() from e
+    if r.status_code != 200:
+        raise TranslationError()
+    return [result['translations'][0]['text'] for result in r.json()]
+
+
+def _request_translation(text, source_language, dest_language) -> str:
+    """
+    Translate text with a request to the Microsoft Translator API.
+    :param text: The text to translate.
+    :param source_language: The language code of the source text.
+    :param dest_language: The language code to translate the text into.
+    :raise TranslationError: If the request fails.
+    :return: The translated text.
+    """
+    return _request_translations([text], source_language, dest_language)[0]
+
+
+def _cache_key(text, source_language, dest_language) -> str:
+    """
+    Return the Redis key of the translation of a text.
+    :param text: The text to translate.
+    :param source_language: The language code of the source text.
+    :param dest_language: The language code to translate the text into.
+    :return: The key.
+    """
+    return 'translate:v2:{}:{}:{}'.format(
+        blake2b(text.encode('utf-8'), digest_size=16).hexdigest(),
+        source_language, dest_language)
+
+
+def _get_local(item) -> str | None:
+    """
+    Look up a translation in the cache of the process, marking it as the most
+    recently used one.
+    :param item: The (text, source_language, dest_language) tuple.
+    :return: The translated text, or None if it is not in the cache.
+    """
+    with _local_translations_lock:
+        translation = _local_translations.get(item)
+        if translation is not None:
+            _local_translations.move_to_end(item)
+    return translation
+
+
+def _set_local(translations) -> None:
+    """
+    Store translations in the cache of the process, discarding the least
+    recently used ones beyond TRANSLATION_CACHE_SIZE.
+    :param translations: A dictionary that maps (text, source_language, dest_language) tuples to the translated texts.
+    :return: None
+    """
+    with _local_translations_lock:
+        _local_translations.update(translations)
+        for item in translations:
+            _local_translations.move_to_end(item)
+        while len(_local_translations) > TRANSLATION_CACHE_SIZE:
+            _local_translations.popitem(last=False)
+
+
+def _cached_translation(text, source_language, dest_language) -> str:
+    """
+    Return the translation of a text, looking it up in the cache of the
+    process and then in Redis before asking the translation service.
+    New translations are stored in both caches, in Redis for
+    TRANSLATION_CACHE_TTL seconds. Errors from Redis are logged and otherwise
+    ignored, so that translations keep working when the cache is down.
+    Failures are not cached.
+    :param text: The text to translate.
+    :param source_language: The language code of the source text.
+    :param dest_language: The language code to translate the text into.
+    :raise TranslationError: If the text is not cached and the translation service fails.
+    :return: The translated text.
+    """
+    item = (text, source_language, dest_language)
+    translation = _get_local(item)
+    if translation is not None:
+        return translation
+    r = get_redis()
+    key = _cache_key(text, source_language, dest_language)
+    if r is not None:
+        try:
+            cached = r.get(key)
+        except Exception:
+            current_app.logger.warning('Translation cache is not available',
+                                       exc_info=True)
+            r = cached = None
+        if cached is not None:
+            translation = json.loads(cached)
+            _set_local({item: translation})
+            return translation
+    translation = _request_translation(text, source_language, dest_language)
+    _set_local({item: translation})
+    if r is not None:
+        try:
+            r.setex(key, current_app.config['TRANSLATION_CACHE_TTL'],
+                    json.dumps(translation))
+        except Exception:
+            current_app.logger.warning('Translation cache is not available',
+                                       exc_info=True)
+    return translation
 
 
 def translate(text, source_language, dest_language) -> str:
@@ -25,15 +226,142 @@ def translate(text, source_language, dest_language) -> str:
     if 'MS_TRANSLATOR_KEY' not in current_app.config or \
             not current_app.config['MS_TRANSLATOR_KEY']:
         return _('Error: the translation service is not configured.')
-    auth = {
-        'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'westus'
-    }
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[
-                {'Text': text}])
-    if r.status_code != 200:
+    try:
+        return _cached_translation(text, source_language, dest_language)
+    except TranslationError:
         return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
+
+
+def _batches(texts):
+    """
+    Split a list of texts into batches that fit in a single request to the
+    translation service.
+    :param texts: The texts to split.
+    :return: A generator of lists of texts.
+    """
+    batch, chars = [], 0
+    for text in texts:
+        if batch and (len(batch) == TRANSLATOR_BATCH_SIZE or
+                      chars + len(text) > TRANSLATOR_BATCH_CHARS):
+            yield batch
+            batch, chars = [], 0
+        batch.append(text)
+        chars += len(text)
+    if batch:
+        yield batch
+
+
+def _try_request_translations(texts, source_language, dest_language,
+                              key=None) -> list | None:
+    """
+    Translate a list of texts like _request_translations(), returning None
+    instead of raising when the request fails.
+    :param texts: The texts to translate.
+    :param source_language: The language code of the source texts.
+    :param dest_language: The language code to translate the texts into.
+    :param key: The subscription key of the service.
+    :return: The translated texts, or None.
+    """
+    try:
+        return _request_translations(texts, source_language, dest_language, key)
+    except TranslationError:
+        return None
+
+
+def translate_many(items) -> list:
+    """
+    Translate many texts, with one request to the translation service for each
+    batch of texts that have the same source and destination languages.
+    Repeated texts are translated once. Translations are looked up in and
+    stored to the same caches as the ones made by translate(), with a single
+    Redis round trip for all the texts.
+    :param items: A list of (text, source_language, dest_language) tuples.
+    :return: The list of translated texts, or error messages for the ones that failed, in the same order as items.
+    """
+    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
+            not current_app.config['MS_TRANSLATOR_KEY']:
+        return [_('Error: the translation service is not configured.')] * len(items)
+    translations = {}
+    missing = []
+    for item in dict.fromkeys(items):
+        translation = _get_local(item)
+        if translation is not None:
+            translations[item] = translation
+        else:
+            missing.append(item)
+    r = get_redis() if missing else None
+    if r is not None:
+        try:
+            cached = r.mget([_cache_key(*item) for item in missing])
+        except Exception:
+            current_app.logger.warning('Translation cache is not available',
+                                       exc_info=True)
+            r = None
+        else:
+            from_redis = {item: json.loads(value)
+                          for item, value in zip(missing, cached)
+                          if value is not None}
+            _set_local(from_redis)
+            translations.update(from_redis)
+    groups: dict[tuple[str, str], list[str]] = {}
+    for text, source_language, dest_language in missing:
+        if (text, source_language, dest_language) not in translations:
+            groups.setdefault((source_language, dest_language), []).append(text)
+    batches = [(batch, source_language, dest_language)
+               for (source_language, dest_language), texts in groups.items()
+               for batch in _batches(texts)]
+    if len(batches) > 1:
+        key = current_app.config['MS_TRANSLATOR_KEY']
+        results = _executor.map(
+            lambda args: _try_request_translations(args[0], args[1], args[2],
+                                                   key), batches)
+    else:
+        results = (_try_request_translations(*args) for args in batches)
+    new_translations: dict[tuple[str, str, str], str] = {}
+    for (batch, source_language, dest_language), translated in zip(batches,
+                                                                   results):
+        if translated is None:
+            continue
+        for text, result in zip(batch, translated):
+            new_translations[(text, source_language, dest_language)] = result
+    _set_local(new_translations)
+    if r is not None and new_translations:
+        try:
+            pipe = r.pipeline(transaction=False)
+            for item, translation in new_translations.items():
+                pipe.setex(_cache_key(*item),
+                           current_app.config['TRANSLATION_CACHE_TTL'],
+                           json.dumps(translation))
+            pipe.execute()
+        except Exception:
+            current_app.logger.warning('Translation cache is not available',
+                                       exc_info=True)
+    translations.update(new_translations)
+    failed = _('Error: the translation service failed.')
+    return [translations.get(item, failed) for item in items]
+
+
+def _open_connection() -> None:
+    """
+    Send a request to the translation service, so that the session keeps an
+    open connection to it. Errors are ignored, since the first translation
+    will just open its own connection.
+    :return: None
+    """
+    try:
+        _session.head(TRANSLATOR_HOST, timeout=5)
+    except requests.RequestException:
+        pass
+
+
+def warm_up(app) -> None:
+    """
+    Open a connection to the translation service in a background thread, so
+    that the first translation of the process does not pay for the TCP and
+    TLS handshakes. Nothing is done when the service is not configured or the
+    application is testing.
+    :param app: The Flask application instance.
+    :return: None
+    """
+    if app.config['MS_TRANSLATOR_KEY'] and not app.testing:
+        Thread(target=_open_connection, daemon=True).start()
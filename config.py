@@ -9,23 +9,56 @@ Usage:
 """
 
 import os
+import pathlib
 from dotenv import load_dotenv
 
-basedir = os.path.abspath(os.path.dirname(__file__))
-load_dotenv(os.path.join(basedir, '.env'))
+_BASEDIR = pathlib.Path(__file__).resolve().parent
+load_dotenv(_BASEDIR / '.env')
+_ENV = os.environ
+
+
+def _env(name, default=None, cast=str):
+    """
+    Read a setting from the environment.
+    An empty value is treated as a missing one, while values that are falsy
+    once converted, such as 0, are kept.
+    :param name: The name of the environment variable.
+    :param default: The value returned when the variable is not set or is empty.
+    :param cast: The function that converts the string value.
+    :return: The converted value, or the default.
+    """
+    value = _ENV.get(name)
+    if value is None or value == '':
+        return default
+    return cast(value)
 
 
 class Config:
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
-        'sqlite:///' + os.path.join(basedir, 'app.db')
-    MAIL_SERVER = os.environ.get('MAIL_SERVER')
-    MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
-    MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
-    MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
-    MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    SECRET_KEY = _env('SECRET_KEY', 'you-will-never-guess')
+    SQLALCHEMY_DATABASE_URI = _env('DATABASE_URL',
+                                   f"sqlite:///{_BASEDIR / 'app.db'}")
+    # Connection pool of the database server; not used with SQLite
+    DATABASE_POOL_SIZE = _env('DATABASE_POOL_SIZE', 20, int)
+    DATABASE_MAX_OVERFLOW = _env('DATABASE_MAX_OVERFLOW', 10, int)
+    DATABASE_POOL_TIMEOUT = _env('DATABASE_POOL_TIMEOUT', 30, int)
+    DATABASE_POOL_RECYCLE = _env('DATABASE_POOL_RECYCLE', 3600, int)
+    DATABASE_STATEMENT_TIMEOUT = _env('DATABASE_STATEMENT_TIMEOUT', 60000, int)
+    MAIL_SERVER = _env('MAIL_SERVER')
+    MAIL_PORT = _env('MAIL_PORT', 25, int)
+    MAIL_USE_TLS = 'MAIL_USE_TLS' in _ENV
+    MAIL_USERNAME = _env('MAIL_USERNAME')
+    MAIL_PASSWORD = _env('MAIL_PASSWORD')
     ADMINS = ['michelegrieco92@google.com']
     LANGUAGES = ['en', 'es']
-    MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_KEY = _env('MS_TRANSLATOR_KEY')
+    # Redis server shared by the workers as a cache of translations and pages
+    REDIS_URL = _env('REDIS_URL')
+    PAGE_CACHE_TIMEOUT = _env('PAGE_CACHE_TIMEOUT', 60, int)
+    TRANSLATION_CACHE_TTL = _env('TRANSLATION_CACHE_TTL', 14 * 24 * 3600, int)
     POSTS_PER_PAGE = 25
-    ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    LAST_SEEN_UPDATE_INTERVAL = _env('LAST_SEEN_UPDATE_INTERVAL', 60, int)
+    USE_VERIFY_PASSWORD_CACHE = 'USE_VERIFY_PASSWORD_CACHE' in _ENV
+    ELASTICSEARCH_URL = _env('ELASTICSEARCH_URL')
+    # Directory of the compiled templates; by default Jinja uses a private
+    # directory of the user running the application
+    JINJA_BYTECODE_CACHE_DIR = _env('JINJA_BYTECODE_CACHE_DIR')
@@ -9,8 +9,6 @@ Usage:
     - Access database models and SQLAlchemy objects in the shell context.
 """
 
-import sqlalchemy as sa
-import sqlalchemy.orm as so
 from app import create_app, db
 from app.models import User, Post
 
@@ -23,6 +21,9 @@ def make_shell_context():
     Provide a shell context for the Flask application.
     This function returns a dictionary of database objects and models to be
     available in the shell.
+    The SQLAlchemy aliases are imported here, since only the shell uses them.
     :return: Dictionary with SQLAlchemy and model references
     """
+    import sqlalchemy as sa
+    import sqlalchemy.orm as so
     return {'sa': sa, 'so': so, 'db': db, 'User': User, 'Post': Post}
@@ -0,0 +1,27 @@
+"""index followers by followed user
+
+Revision ID: 5e8a17c3b2d4
+Revises: 9d2f6a41c8e5
+Create Date: 2026-10-15 18:42:09.716530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8a17c3b2d4'
+down_revision = '9d2f6a41c8e5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.create_index('ix_followers_followed_id', ['followed_id'],
+                              unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id')
@@ -0,0 +1,46 @@
+"""denormalized follow counts
+
+Revision ID: b81f0c6d93a7
+Revises: 5e8a17c3b2d4
+Create Date: 2026-10-15 19:10:27.380452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81f0c6d93a7'
+down_revision = '5e8a17c3b2d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('follower_count', sa.Integer(),
+                                      server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('followed_count', sa.Integer(),
+                                      server_default='0', nullable=False))
+
+    # backfill the counts from the followers table
+    user = sa.table('user', sa.column('id', sa.Integer),
+                    sa.column('follower_count', sa.Integer),
+                    sa.column('followed_count', sa.Integer))
+    followers = sa.table('followers', sa.column('follower_id', sa.Integer),
+                         sa.column('followed_id', sa.Integer))
+    op.execute(user.update().values(
+        follower_count=sa.select(sa.func.count()).where(
+            followers.c.followed_id == user.c.id).scalar_subquery(),
+        followed_count=sa.select(sa.func.count()).where(
+            followers.c.follower_id == user.c.id).scalar_subquery()))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('follower_count')
+    # On SQLite the table is copied, and the copy loses the expression index
+    op.create_index('ix_user_username_lower', 'user',
+                    [sa.text('lower(username)')], unique=True,
+                    if_not_exists=True)
@@ -0,0 +1,29 @@
+"""post user timestamp index
+
+Revision ID: e3c94a5f0b17
+Revises: b81f0c6d93a7
+Create Date: 2026-10-15 19:48:53.104622
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3c94a5f0b17'
+down_revision = 'b81f0c6d93a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_timestamp',
+                              ['user_id', 'timestamp'], unique=False)
+        batch_op.drop_index('ix_post_user_id')
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id', ['user_id'], unique=False)
+        batch_op.drop_index('ix_post_user_timestamp')
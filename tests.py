@@ -5,15 +5,25 @@ Module name: tests.py
 Author: Michele Grieco
 Description:
     Unit tests for the User and Post models in the Flask microblog application.
-    Tests cover password hashing, avatar generation, following functionality, and post retrieval.
+    Tests cover password hashing, avatar generation, password reset tokens, following functionality
+    and post retrieval, as well as the validation of the page to redirect to after login
+    and the behavior of some of the routes, which are called with the test client,
+    and the batching and caching of the translations, with a mocked translation service.
 Usage:
     - Run the tests using a test runner like unittest.
 """
 
 from datetime import datetime, timezone, timedelta
+import json
 import unittest
+from unittest import mock
+import sqlalchemy as sa
 from app import create_app, db
 from app.models import User, Post
+from app.auth.routes import is_safe_next_page
+from app.main.routes import paginate_posts, parse_cursor, post_cursor
+from app import translate as translate_module
+from app.translate import translate, translate_many
 from config import Config
 
 
@@ -23,18 +33,58 @@ class TestConfig(Config):
     ELASTICSEARCH_URL = None
 
 
-class UserModelCase(unittest.TestCase):
-    def setUp(self):
-        self.app = create_app(TestConfig)
-        self.app_context = self.app.app_context()
-        self.app_context.push()
+class RoutesTestConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+
+
+class TranslateTestConfig(TestConfig):
+    MS_TRANSLATOR_KEY = 'test-key'
+    REDIS_URL = None
+
+
+class DatabaseCase(unittest.TestCase):
+    # The schema is created once for the whole class. Each test runs in a
+    # transaction that is rolled back at the end, and the commits made by the
+    # test only release savepoints inside it.
+    config = TestConfig
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(cls.config)
+        cls.app_context = cls.app.app_context()
+        cls.app_context.push()
         db.create_all()
 
+    @classmethod
+    def tearDownClass(cls):
+        db.drop_all()
+        cls.app_context.pop()
+
+    def setUp(self):
+        self.connection = db.engine.connect()
+        # let SQLAlchemy, not the sqlite3 module, begin the transactions, so
+        # that the savepoints work
+        self.connection.connection.driver_connection.isolation_level = None
+        sa.event.listen(self.connection, 'begin',
+                        lambda conn: conn.exec_driver_sql('BEGIN'))
+        self.transaction = self.connection.begin()
+        # Flask-SQLAlchemy's session picks its bind from the engines of the
+        # app, so the test connection takes the place of the default engine;
+        # the session joins its transaction and commits only release savepoints
+        self.engines = mock.patch.dict(db.engines, {None: self.connection})
+        self.engines.start()
+        db.session.remove()
+        db.session.configure(join_transaction_mode='create_savepoint')
+
     def tearDown(self):
         db.session.remove()
-        db.drop_all()
-        self.app_context.pop()
+        db.session.configure(join_transaction_mode='conservative_savepoint')
+        self.engines.stop()
+        self.transaction.rollback()
+        self.connection.close()
 
+
+class UserModelCase(DatabaseCase):
     def test_password_hashing(self):
         u = User(username='susan', email='susan@example.com')
         u.set_password('cat')
@@ -47,6 +97,15 @@ class UserModelCase(unittest.TestCase):
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    def test_reset_password_token(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_reset_password_token()
+        self.assertEqual(User.verify_reset_password_token(token), u)
+        self.assertEqual(User.verify_reset_password_token(token), u)
+        self.assertIsNone(User.verify_reset_password_token(token + 'x'))
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -74,6 +133,20 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following_count(), 0)
         self.assertEqual(u2.followers_count(), 0)
 
+    def test_follow_many(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow_many([u2, u3, u3])
+        db.session.commit()
+        self.assertTrue(u1.is_following(u3))
+        self.assertEqual(u1.following_count(), 2)
+        self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(u3.followers_count(), 1)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -113,5 +186,188 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class PaginationCase(DatabaseCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['POSTS_PER_PAGE'] = 2
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        now = datetime.now(timezone.utc)
+        # three of the posts have the same timestamp, so that pages are split
+        # by the id tiebreak
+        timestamps = [now - timedelta(seconds=s) for s in (1, 2, 2, 2, 3)]
+        db.session.add_all([Post(body=f'post {i}', author=u, timestamp=t)
+                            for i, t in enumerate(timestamps)])
+        db.session.commit()
+        self.expected = db.session.scalars(sa.select(Post.id).order_by(
+            Post.timestamp.desc(), Post.id.desc())).all()
+
+    def tearDown(self):
+        self.app.config['POSTS_PER_PAGE'] = TestConfig.POSTS_PER_PAGE
+        super().tearDown()
+
+    def get_page(self, url):
+        with self.app.test_request_context(url):
+            posts, next_url, prev_url = paginate_posts(sa.select(Post),
+                                                       'main.explore')
+        return [p.id for p in posts], next_url, prev_url
+
+    def test_cursor_round_trip(self):
+        post = db.session.get(Post, self.expected[0])
+        self.assertEqual(parse_cursor(post_cursor(post)),
+                         (post.timestamp, post.id))
+        self.assertIsNone(parse_cursor(None))
+        self.assertIsNone(parse_cursor('garbage'))
+        self.assertIsNone(parse_cursor('2024-01-01T00:00:00_x'))
+
+    def test_pages(self):
+        ids, next_url, prev_url = self.get_page('/explore')
+        self.assertEqual(ids, self.expected[:2])
+        self.assertIsNone(prev_url)
+
+        # going to older pages visits every post once
+        seen = list(ids)
+        while next_url:
+            ids, next_url, prev_url = self.get_page(next_url)
+            self.assertIsNotNone(prev_url)
+            seen += ids
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(ids, self.expected[4:])
+
+        # and going back to newer pages returns the same pages in reverse
+        ids, next_url, prev_url = self.get_page(prev_url)
+        self.assertEqual(ids, self.expected[2:4])
+        ids, next_url, prev_url = self.get_page(prev_url)
+        self.assertEqual(ids, self.expected[:2])
+        self.assertIsNone(prev_url)
+        self.assertIsNotNone(next_url)
+
+    def test_malformed_cursor(self):
+        ids, next_url, prev_url = self.get_page('/explore?before=garbage')
+        self.assertEqual(ids, self.expected[:2])
+        self.assertIsNone(prev_url)
+
+
+class RoutesCase(DatabaseCase):
+    config = RoutesTestConfig
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+
+    def add_user(self, username, password='cat'):
+        u = User(username=username, email=f'{username}@example.com')
+        u.set_password(password)
+        db.session.add(u)
+        db.session.commit()
+        return u
+
+    def login(self, username, password='cat'):
+        return self.client.post('/auth/login', data={
+            'username': username, 'password': password})
+
+    def test_rename_changes_etag(self):
+        self.add_user('john')
+        self.login('john')
+        r = self.client.get('/explore')
+        self.assertEqual(r.status_code, 200)
+        etag = r.headers['ETag']
+        r = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.client.post('/edit_profile', data={'username': 'johnny',
+                                                'about_me': ''})
+        self.client.get('/index')  # consume the flashed message
+        r = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b'/user/johnny', r.data)
+
+    def register(self, username, email):
+        return self.client.post('/auth/register', data={
+            'username': username, 'email': email,
+            'password': 'cat', 'password2': 'cat'})
+
+    def test_register_duplicate_username(self):
+        self.add_user('john')
+        r = self.register('JOHN', 'other@example.com')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b'Please use a different username.', r.data)
+        self.assertNotIn(b'Please use a different email address.', r.data)
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count()).select_from(User)), 1)
+
+    def test_register_duplicate_email(self):
+        self.add_user('john')
+        r = self.register('susan', 'John@Example.com')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b'Please use a different email address.', r.data)
+        self.assertNotIn(b'Please use a different username.', r.data)
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count()).select_from(User)), 1)
+
+
+class TranslateCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TranslateTestConfig)
+        self.request_context = self.app.test_request_context()
+        self.request_context.push()
+        translate_module._local_translations.clear()
+        self.requests = []
+        self.post = mock.patch.object(translate_module._session, 'post',
+                                      side_effect=self.fake_post)
+        self.post.start()
+
+    def tearDown(self):
+        self.post.stop()
+        translate_module._local_translations.clear()
+        self.request_context.pop()
+
+    def fake_post(self, url, params, headers, data, timeout):
+        texts = [item['Text'] for item in json.loads(data)]
+        self.requests.append((params['to'], texts))
+        response = mock.Mock()
+        if params['to'] == 'xx':
+            response.status_code = 500
+        else:
+            response.status_code = 200
+            response.json.return_value = [
+                {'translations': [{'text': f'{params["to"]}:{text}'}]}
+                for text in texts]
+        return response
+
+    def test_translate_many(self):
+        with mock.patch.object(translate_module, 'TRANSLATOR_BATCH_SIZE', 2):
+            result = translate_many([('a', 'en', 'es'), ('b', 'en', 'es'),
+                                     ('a', 'en', 'es'), ('c', 'en', 'es'),
+                                     ('d', 'es', 'en'), ('e', 'en', 'xx')])
+        self.assertEqual(result, ['es:a', 'es:b', 'es:a', 'es:c', 'en:d',
+                                  'Error: the translation service failed.'])
+        # one request per batch of two texts of the same language pair, and
+        # repeated texts are only sent once
+        self.assertEqual(sorted(self.requests), [
+            ('en', ['d']), ('es', ['a', 'b']), ('es', ['c']), ('xx', ['e'])])
+
+        # translations are cached for translate() and translate_many(), while
+        # failures are requested again
+        self.requests.clear()
+        self.assertEqual(translate('b', 'en', 'es'), 'es:b')
+        self.assertEqual(translate_many([('a', 'en', 'es'), ('e', 'en', 'xx')]),
+                         ['es:a', 'Error: the translation service failed.'])
+        self.assertEqual(self.requests, [('xx', ['e'])])
+
+
+class AuthRoutesCase(unittest.TestCase):
+    def test_safe_next_page(self):
+        self.assertTrue(is_safe_next_page('/index'))
+        self.assertTrue(is_safe_next_page('/user/john?page=2#posts'))
+        self.assertFalse(is_safe_next_page(None))
+        self.assertFalse(is_safe_next_page(''))
+        self.assertFalse(is_safe_next_page('//evil.com'))
+        self.assertFalse(is_safe_next_page('/\\evil.com'))
+        self.assertFalse(is_safe_next_page('/\t/evil.com'))
+        self.assertFalse(is_safe_next_page('/\n/evil.com'))
+        self.assertFalse(is_safe_next_page('http://evil.com'))
+        self.assertFalse(is_safe_next_page('javascript:alert(1)'))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)